@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Usage: bench_cache_codecs.py -h
+
+Compares the cache codecs of sisu2gv.py on both cache backends: the bytes
+on disk and the time of a warm full-programme run (resolving a synthetic
+programme with all of its responses read from the cache). Runs offline,
+the data is generated with sisu_synth.py.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+import sisu2gv
+import sisu_synth
+
+YEAR = 2022
+
+def disk_usage(location):
+    """ Bytes in the files of the cache directory (or the database file). """
+    if path.isfile(location):
+        return path.getsize(location)
+    return sum(path.getsize(path.join(location, fn)) for fn in os.listdir(location))
+
+def location_for(backend, work_dir, codec):
+    if backend=='sqlite':
+        return path.join(work_dir, f"{codec}.sqlite")
+    return path.join(work_dir, f"{codec}_dir")
+
+def warm_run(backend, location, pgid):
+    """ Resolves the programme reading everything from the cache, returns the
+    wall time, the time spent decoding and the result. """
+    decode_before = sisu2gv.profiler.times.get("json_decode", 0.0)
+    start = time.perf_counter()
+    response_cache = sisu2gv.MemoCache(sisu2gv.open_cache(backend, location), max_entries=10**6)
+    resolver = sisu2gv.CurriculumResolver(sisu2gv.CURRICULUM_CODE%YEAR, response_cache=response_cache)
+    module_hierarchy = resolver.resolve(pgid, workers=0)
+    response_cache.close()
+    elapsed = time.perf_counter()-start
+    decode_time = sisu2gv.profiler.times.get("json_decode", 0.0)-decode_before
+    return elapsed, decode_time, (module_hierarchy, resolver.cid2c)
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--courses", default=2000, type=int, help="number of courses in the programme")
+    parser.add_argument("-r", "--repeats", default=3, type=int)
+    parser.add_argument("--projection", action='store_true', help="cache only the used fields of the responses")
+    args = parser.parse_args()
+
+    codecs = sisu2gv.available_codecs()
+    work_dir = tempfile.mkdtemp(prefix="bench_cache_codecs_")
+    try:
+        source = sisu2gv.JsonDirCache(path.join(work_dir, "source"))
+        pgid = sisu_synth.generate_to_cache(source, courses=args.courses, years=[YEAR])
+        print(f"{pgid}, {len(source.ids())} responses"+(" (projected)" if args.projection else ""))
+        print(f"{'backend':<10}{'codec':<10}{'bytes':>12}{'warm run ms':>14}{'decode ms':>12}")
+
+        expected = None
+        for backend in sisu2gv.CACHE_BACKENDS:
+            for codec in codecs:
+                location = location_for(backend, work_dir, codec)
+                target = sisu2gv.open_cache(backend, location, codec=codec)
+                sisu2gv.migrate_cache(source, target, args.projection)
+                target.close()
+
+                runs = [warm_run(backend, location, pgid) for _ in range(args.repeats)]
+                elapsed, decode_time, result = min(runs, key=lambda run: run[0])
+                if expected is None:
+                    expected = result
+                assert result==expected, f"{backend}/{codec} resolved a different programme"
+                print(f"{backend:<10}{codec:<10}{disk_usage(location):>12}{elapsed*1000:>14.1f}{decode_time*1000:>12.1f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,12 @@
+"""
+Helpers shared by the benchmarks.
+"""
+
+class DictCache:
+    """ Minimal in-memory stand-in for the cache backends. """
+    def __init__(self, entries):
+        self.entries = entries
+    def get(self, id, include_expired=False):
+        return self.entries.get(id)
+    def put(self, id, data, validators=None, kind=None):
+        self.entries[id] = data
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Usage: bench_gv_writer.py -h
+
+Compares the graphviz writer of sisu2gv.py against the earlier closure
+based one, that wrote piece by piece to the file and used lists for the
+membership tests, on a synthetic programme. Runs offline, the programme is
+generated with sisu_synth.py and kept in memory.
+"""
+
+import shutil
+import sys
+import tempfile
+import textwrap
+import time
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+import sisu2gv
+import sisu_synth
+from bench_common import DictCache
+
+YEAR = 2022
+
+def write_gv_closures(module_hierarchy, cid2c, output_gv_file_path, also_recommended=True,
+                      course_blacklist=[], extra_data={}):
+    """ The writer as it was before. """
+    course_blacklist = [cc.replace(".","_") for cc in course_blacklist or []]
+
+    with open(output_gv_file_path, 'w', encoding="utf-8") as wf:
+        wf.write("digraph G {\n")
+        wf.write("rankdir=\"LR\";\n")
+
+        sgidx = 1
+        indent = 0
+
+        in_clusters = []
+        all_com_prqs = []
+        all_rec_prqs = []
+
+        def write_course(c):
+            nonlocal indent, all_com_prqs, all_rec_prqs
+
+            ck1 = c['key']
+            cc1 = c['code']
+            wrapname = textwrap.fill(c['name'], 20, max_lines=3, placeholder="...").replace('\n',r'<BR/>')
+            icon =  ' '+extra_data['course_icons'][ck1] if extra_data and ck1 in extra_data['course_icons'] else ''
+            wf.write(indent*"  "+f"{ck1} [shape=plaintext, label=<\n"+
+            (indent+1)*"  "+""" <TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0">\n"""+
+            (indent+2)*"  "+f"<TR><TD>{cc1+icon}</TD></TR>\n"+
+            (indent+2)*"  "+f"<TR><TD>{wrapname}</TD></TR>\n"+
+            (indent+1)*"  "+"</TABLE> > ];\n")
+
+            for pr in c['com_prqs']:
+                if pr in cid2c:
+                    all_com_prqs.append((cid2c[pr]['key'], ck1))
+            for pr in c['rec_prqs']:
+                if pr in cid2c:
+                    all_rec_prqs.append((cid2c[pr]['key'], ck1))
+
+        def write_cluster(sg, blacklist):
+            nonlocal sgidx, indent, in_clusters
+
+            wf.write(indent*"  "+"subgraph cluster_%d {\n"%sgidx)
+            sgidx+=1
+            indent+=1
+            wf.write(indent*"  "+"label = \"%s\";\n"%sg['name'])
+
+            for c in sg['children']:
+                if 'children' in c:
+                    write_cluster(c, blacklist)
+                else:
+                    if c['key'] in blacklist:
+                        continue
+                    write_course(c)
+                    in_clusters.append(c['key'])
+
+            indent-=1
+            wf.write(indent*"  "+"}\n")
+
+        def write_prerequisites(prqs, blacklist, style=""):
+            for from_c, to_c in prqs:
+                if from_c in blacklist or to_c in blacklist: continue
+
+                if style:
+                    wf.write(indent*"  "+f"{from_c}->{to_c} [style=\"{style}\"];\n")
+                else:
+                    wf.write(indent*"  "+f"{from_c}->{to_c};\n")
+
+        for sg in module_hierarchy:
+            write_cluster(sg, course_blacklist)
+
+        active_prqs = []
+        write_prerequisites(all_com_prqs, course_blacklist, style="")
+        active_prqs+=[prq for prq, c in all_com_prqs]
+        if also_recommended:
+            write_prerequisites(all_rec_prqs, course_blacklist, style="dashed")
+            active_prqs+=[prq for prq, c in all_rec_prqs]
+
+        loose_courses = []
+        wf.write("{ rank=source; ")
+        for c in cid2c.values():
+            cc = c['code']
+            ck = c['key']
+            if cc in in_clusters or \
+               ck in course_blacklist or \
+               ck not in active_prqs:
+                continue
+            wf.write(f"{ck}; ")
+            loose_courses.append(c)
+        wf.write("}\n")
+
+        for c in loose_courses:
+            write_course(c)
+
+        wf.write("}\n")
+
+def best_time(write, repeats, *args):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        write(*args)
+        elapsed = time.perf_counter()-start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--courses", default=10000, type=int, help="number of courses in the programme")
+    parser.add_argument("-r", "--repeats", default=3, type=int)
+    parser.add_argument("--blacklist", default=50, type=int, help="number of courses to blacklist")
+    args = parser.parse_args()
+
+    pgid, entries = sisu_synth.SynthProgramme(courses=args.courses, years=[YEAR],
+        depth=2 if args.courses<10000 else 3).generate()
+    resolver = sisu2gv.CurriculumResolver(sisu2gv.CURRICULUM_CODE%YEAR,
+        response_cache=sisu2gv.MemoCache(DictCache(entries), max_entries=10**6))
+    module_hierarchy = resolver.resolve(pgid, workers=0)
+    cid2c = resolver.cid2c
+    blacklist = [c['code'] for c in list(cid2c.values())[::max(1, len(cid2c)//max(1, args.blacklist))]]
+
+    work_dir = tempfile.mkdtemp(prefix="bench_gv_writer_")
+    old_path = path.join(work_dir, "closures.gv")
+    new_path = path.join(work_dir, "gv_writer.gv")
+    try:
+        old_time = best_time(write_gv_closures, args.repeats, module_hierarchy, cid2c, old_path, True, blacklist)
+        new_time = best_time(sisu2gv.write_gv, args.repeats, module_hierarchy, cid2c, new_path, True, blacklist)
+        with open(old_path, 'r', encoding='utf-8') as rf_old, open(new_path, 'r', encoding='utf-8') as rf_new:
+            assert rf_old.read()==rf_new.read(), "the graphviz files differ"
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{len(cid2c)} courses, {len(blacklist)} blacklisted")
+    print(f"  closure writer: {old_time*1000:9.1f} ms")
+    print(f"  GvWriter:       {new_time*1000:9.1f} ms  ({old_time/new_time:.1f}x faster)")
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Usage: bench_sisu2gv.py -h
+
+Benchmarks the stages of the sisu2gv.py pipeline (crawl, parse, validate,
+compress, write) separately and end-to-end on synthetic programmes. Runs
+offline: the data is generated with sisu_synth.py and the cold crawl is
+served by sisu_stub_server.py. For each stage the best wall time over the
+repeats, the peak memory (traced in a separate run) and the profiler
+counters are recorded. The results can be stored as a baseline and later
+runs compared against it, exiting with status 1 on a regression.
+"""
+
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+import sisu2gv
+import sisu_stub_server
+import sisu_synth
+
+YEAR = 2022
+
+class Workload:
+    """ A synthetic programme in a cache directory and the stand-in server
+    serving it. """
+
+    def __init__(self, courses, workers, work_dir):
+        self.courses = courses
+        self.workers = workers
+        self.work_dir = work_dir
+        self.cache_dir = path.join(work_dir, "cache_%d"%courses)
+        fixtures = sisu2gv.JsonDirCache(self.cache_dir)
+        self.pgid = sisu_synth.generate_to_cache(fixtures, courses=courses, years=[YEAR],
+            depth=2 if courses<10000 else 3)
+        self.curriculum = sisu2gv.CURRICULUM_CODE%YEAR
+        self.server, self.base_url = sisu_stub_server.start_in_thread(
+            sisu_stub_server.StubState(fixtures))
+        sisu2gv.set_base_url(self.base_url)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def warm_resolver(self):
+        """ A resolver reading the data from the disk cache. """
+        return sisu2gv.CurriculumResolver(self.curriculum,
+            response_cache=sisu2gv.MemoCache(sisu2gv.JsonDirCache(self.cache_dir), max_entries=10**6))
+
+    def cold_resolver(self):
+        """ A resolver with an empty cache, fetching from the stand-in. """
+        cold_dir = tempfile.mkdtemp(dir=self.work_dir)
+        return sisu2gv.CurriculumResolver(self.curriculum,
+            response_cache=sisu2gv.MemoCache(sisu2gv.JsonDirCache(cold_dir), max_entries=10**6),
+            sisu_fetcher=sisu2gv.SisuFetcher(pool_size=max(self.workers, 1)))
+
+    def in_memory_resolver(self):
+        """ A resolver that has all the responses already decoded in memory. """
+        resolver = self.warm_resolver()
+        resolver.crawl(resolver.get_programme(self.pgid), self.workers)
+        resolver.used_ids.clear()
+        return resolver
+
+# Each stage is a (setup, run) pair: setup prepares the state outside the
+# measurement and run is the measured part.
+
+def stage_crawl_cold(w):
+    def setup():
+        resolver = w.cold_resolver()
+        return resolver, resolver.get_programme(w.pgid)
+    return setup, lambda state: state[0].crawl(state[1], w.workers)
+
+def stage_crawl_warm(w):
+    def setup():
+        resolver = w.warm_resolver()
+        return resolver, resolver.get_programme(w.pgid)
+    return setup, lambda state: state[0].crawl(state[1], w.workers)
+
+def stage_parse(w):
+    def setup():
+        resolver = w.in_memory_resolver()
+        return resolver, resolver.get_programme(w.pgid)
+    return setup, lambda state: state[0].parse_programme(state[1])
+
+def stage_validate(w):
+    def setup():
+        resolver = w.in_memory_resolver()
+        resolver.parse_programme(resolver.get_programme(w.pgid))
+        return resolver
+    return setup, lambda resolver: resolver.validate_and_clean_queued_preprequisites()
+
+def stage_compress(w):
+    def setup():
+        resolver = w.in_memory_resolver()
+        module_hierarchy = resolver.parse_programme(resolver.get_programme(w.pgid))
+        resolver.validate_and_clean_queued_preprequisites()
+        return module_hierarchy
+    return setup, sisu2gv.compress
+
+def stage_write(w):
+    def setup():
+        resolver = w.in_memory_resolver()
+        return resolver.resolve(w.pgid, workers=0), resolver.cid2c
+    def run(state):
+        sisu2gv.write_gv(state[0], state[1], path.join(w.work_dir, "bench.gv"), also_recommended=True)
+    return setup, run
+
+def stage_end_to_end(w):
+    def run(resolver):
+        module_hierarchy = resolver.resolve(w.pgid, w.workers)
+        sisu2gv.write_gv(module_hierarchy, resolver.cid2c, path.join(w.work_dir, "bench.gv"), also_recommended=True)
+    return w.warm_resolver, run
+
+STAGES = {
+    'crawl_cold': stage_crawl_cold,
+    'crawl_warm': stage_crawl_warm,
+    'parse': stage_parse,
+    'validate': stage_validate,
+    'compress': stage_compress,
+    'write': stage_write,
+    'end_to_end': stage_end_to_end,
+}
+
+def measure(setup, run, repeats):
+    """ Returns the best time, the peak traced memory and the profiler
+    counters of one run. """
+    best = None
+    for _ in range(repeats):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        elapsed = time.perf_counter()-start
+        best = elapsed if best is None else min(best, elapsed)
+
+    state = setup()
+    counters_before = dict(sisu2gv.profiler.counters)
+    tracemalloc.start()
+    run(state)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    counters = {name:value-counters_before.get(name, 0) for name, value in sisu2gv.profiler.counters.items()
+        if value!=counters_before.get(name, 0)}
+    return {'time':best, 'peak_memory':peak, 'counters':counters}
+
+def compare(results, baseline, tolerance):
+    """ Returns the list of regressions against the baseline. """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ('time', 'peak_memory'):
+            old = baseline[key][metric]
+            new = result[metric]
+            if old and new>old*(1.0+tolerance):
+                regressions.append(f"{key} {metric}: {old:.4g} -> {new:.4g} (+{100.0*(new/old-1.0):.0f}%)")
+    return regressions
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--courses", default=[1000], type=lambda s: [int(n) for n in s.split(',')],
+                        help="comma separated programme sizes in courses (e.g. 1000,10000)")
+    parser.add_argument("-s", "--stages", default=list(STAGES.keys()), type=lambda s: s.split(','),
+                        help="comma separated stages to run: "+", ".join(STAGES.keys()))
+    parser.add_argument("-r", "--repeats", default=3, type=int)
+    parser.add_argument("-w", "--workers", default=8, type=int)
+    parser.add_argument("-o", "--output", default=None, help="write the results to this .json file")
+    parser.add_argument("-b", "--baseline", default=None, help="compare against the results in this .json file")
+    parser.add_argument("--save-baseline", action='store_true', help="write the results to the --baseline file")
+    parser.add_argument("-t", "--tolerance", default=0.25, type=float,
+                        help="allowed relative slowdown or memory growth before reporting a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+    work_dir = tempfile.mkdtemp(prefix="bench_sisu2gv_")
+    results = {}
+    try:
+        for courses in args.courses:
+            workload = Workload(courses, args.workers, work_dir)
+            try:
+                for stage in args.stages:
+                    setup, run = STAGES[stage](workload)
+                    result = measure(setup, run, args.repeats)
+                    results[f"{stage}@{courses}"] = result
+                    print(f"{stage:<12}{courses:>8} courses {result['time']*1000:10.1f} ms "+
+                          f"{result['peak_memory']/2**20:8.1f} MiB  {result['counters']}")
+            finally:
+                workload.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as wf:
+            json.dump(results, wf, indent=2)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as wf:
+            json.dump(results, wf, indent=2)
+    elif args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as rf:
+            baseline = json.load(rf)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION "+regression)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Usage: bench_validate.py -h
+
+Compares the prerequisite validation of sisu2gv.py against the earlier
+quadratic implementation on a synthetic programme with thousands of
+prerequisite references. Runs offline, the course data is kept in memory.
+"""
+
+import random
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+import sisu2gv
+from bench_common import DictCache
+
+CURRICULUM = "uta-lvv-2022"
+
+class QuadraticResolver(sisu2gv.CurriculumResolver):
+    """ The validation as it was before: parse per reference, list.remove per invalid id. """
+    def validate_and_clean_queued_preprequisites(self):
+        for reqs in self.queued_prerequisites:
+            to_rm = []
+            for rq in reqs:
+                if self.parse_course(rq, in_main_tree=False) is None:
+                    to_rm.append(rq)
+            for rmid in to_rm:
+                reqs.remove(rmid)
+
+def make_courses(n_courses, invalid_share, seed):
+    """ Returns course data keyed by id. A share of the courses is not valid
+    for the benchmarked curriculum. """
+    rnd = random.Random(seed)
+    entries = {}
+    for i in range(n_courses):
+        periods = ["uta-lvv-2021"] if rnd.random()<invalid_share else [CURRICULUM]
+        entries["course-%d"%i] = [{
+            'code':"BENCH.%d"%i, 'name':{'fi':"Kurssi %d"%i},
+            'curriculumPeriodIds':periods,
+            'recommendedFormalPrerequisites':[], 'compulsoryFormalPrerequisites':[]}]
+    return entries
+
+def make_queue(n_courses, n_lists, list_len, seed):
+    rnd = random.Random(seed)
+    return [["course-%d"%rnd.randrange(n_courses) for _ in range(list_len)] for _ in range(n_lists)]
+
+def run(resolver_class, entries, queue):
+    resolver = resolver_class(CURRICULUM, response_cache=sisu2gv.MemoCache(DictCache(entries)))
+    resolver.queued_prerequisites = [list(reqs) for reqs in queue]
+    start = time.perf_counter()
+    resolver.validate_and_clean_queued_preprequisites()
+    return time.perf_counter()-start, resolver.queued_prerequisites
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--courses", default=2000, type=int, help="number of distinct courses")
+    parser.add_argument("--lists", default=1000, type=int, help="number of queued prerequisite lists")
+    parser.add_argument("--list-length", default=20, type=int, help="prerequisite references per list")
+    parser.add_argument("--invalid", default=0.3, type=float, help="share of the courses not valid for the curriculum")
+    parser.add_argument("--seed", default=1, type=int)
+    args = parser.parse_args()
+
+    entries = make_courses(args.courses, args.invalid, args.seed)
+    queue = make_queue(args.courses, args.lists, args.list_length, args.seed)
+
+    old_time, old_result = run(QuadraticResolver, entries, queue)
+    new_time, new_result = run(sisu2gv.CurriculumResolver, entries, queue)
+    assert old_result==new_result, "the validation results differ"
+
+    print(f"{args.lists*args.list_length} prerequisite references to {args.courses} courses")
+    print(f"  per-reference validation: {old_time*1000:9.1f} ms")
+    print(f"  unique-id validation:     {new_time*1000:9.1f} ms  ({old_time/new_time:.1f}x faster)")
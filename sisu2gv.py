@@ -16,208 +16,1715 @@ import requests
 import json
 import logging
 import textwrap
+import shutil
+import time
+import random
+import sqlite3
+import subprocess
+import threading
+import zlib
+import hashlib
+import io
+
+try:
+    import msgpack
+except ImportError:
+    # optional, only needed for the msgpack cache codec
+    msgpack = None
 
 from pprint import pprint
+import os
+import sys
 from os import path
 from datetime import date
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 
-# Global datastructure to store and map course id/code to course data
-cid2c = {}
-# Global datastructure to store prerequisites for processing
-queued_prerequisites = []
 cache_dir = "./cache/"
 
-SISU_PROG_URL = 'https://sis-tuni.funidata.fi/kori/api/modules/'
-SISU_GROUP_URL = 'https://sis-tuni.funidata.fi/kori/api/modules/by-group-id'
-SISU_COURSE_URL = 'https://sis-tuni.funidata.fi/kori/api/course-units/by-group-id'
+SISU_BASE_URL = 'https://sis-tuni.funidata.fi'
+SISU_PROG_URL = SISU_BASE_URL+'/kori/api/modules/'
+SISU_GROUP_URL = SISU_BASE_URL+'/kori/api/modules/by-group-id'
+SISU_COURSE_URL = SISU_BASE_URL+'/kori/api/course-units/by-group-id'
+
+def set_base_url(base_url):
+    """ Points the Sisu endpoints to another server, e.g. to a local
+    sisu_stub_server.py. """
+    global SISU_BASE_URL, SISU_PROG_URL, SISU_GROUP_URL, SISU_COURSE_URL
+    SISU_BASE_URL = base_url.rstrip('/')
+    SISU_PROG_URL = SISU_BASE_URL+'/kori/api/modules/'
+    SISU_GROUP_URL = SISU_BASE_URL+'/kori/api/modules/by-group-id'
+    SISU_COURSE_URL = SISU_BASE_URL+'/kori/api/course-units/by-group-id'
+
+class Profiler:
+    """ Collects the time spent in the phases of a run and event counters.
+    The phases may nest (e.g. cache_read includes json_decode) and the
+    phases timed in concurrent threads are summed, so their total can be
+    more than the wall time. """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter()-start
+            with self.lock:
+                self.times[name] = self.times.get(name, 0.0)+elapsed
+                self.calls[name] = self.calls.get(name, 0)+1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0)+n
+
+    def report(self):
+        with self.lock:
+            return {
+                'wall_time': time.perf_counter()-self.started,
+                'phases': {name:{'time':self.times[name], 'calls':self.calls[name]} for name in self.times},
+                'counters': dict(self.counters),
+            }
+
+    def summary(self):
+        report = self.report()
+        lines = [f"{'phase':<16}{'calls':>10}{'total s':>12}{'mean ms':>12}"]
+        for name, phase in sorted(report['phases'].items(), key=lambda np: -np[1]['time']):
+            lines.append(f"{name:<16}{phase['calls']:>10}{phase['time']:>12.3f}{1000*phase['time']/phase['calls']:>12.3f}")
+        lines.append(f"{'wall time':<26}{report['wall_time']:>12.3f}")
+        for name, value in sorted(report['counters'].items()):
+            lines.append(f"{name:<16}{value:>10}")
+        return "\n".join(lines)
+
+profiler = Profiler()
+
+class AdaptiveRateLimiter:
+    """ Limits the requests to Sisu with a token bucket (at most rate requests
+    per second) and an adaptive concurrency limit. Both are adjusted AIMD
+    style: halved when the server throttles (HTTP 429 or 503) and increased
+    additively back towards their maximum while the responses arrive within
+    the target latency. They are halved once per congestion event: the
+    throttled responses to requests sent before the last decrease do not
+    decrease them again.
+
+    :param float rate: Maximum requests per second (0 is unlimited).
+    :param int max_concurrency: Maximum number of requests in flight.
+    :param float target_latency: Responses slower than this (s) do not ramp up.
+    """
+
+    THROTTLE_STATUSES = (429, 503)
+
+    def __init__(self, rate=0.0, max_concurrency=10, target_latency=2.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.first_request = None
+        self.last_response = None
+        self.last_decrease = None
+        self.requests = 0
+        self.throttled = 0
+
+    def acquire(self):
+        """ Blocks until a request may be sent. """
+        with self.cond:
+            while self.in_flight>=int(self.limit):
+                self.cond.wait()
+            self.in_flight+=1
+            while self.rate:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens+(now-self.last_refill)*self.rate)
+                self.last_refill = now
+                if self.tokens>=1.0:
+                    self.tokens-=1.0
+                    break
+                self.cond.wait((1.0-self.tokens)/self.rate)
+            if self.first_request is None:
+                self.first_request = time.monotonic()
+
+    def release(self, status=None, latency=0.0):
+        """ Frees the slot taken by acquire and adapts the limits to how the
+        request went (status is None if there was no response). """
+        with self.cond:
+            self.in_flight-=1
+            self.requests+=1
+            self.last_response = time.monotonic()
+            if status in self.THROTTLE_STATUSES:
+                self.throttled+=1
+                sent_at = self.last_response-latency
+                # the requests already in flight when the limits were last
+                #  halved belong to the same congestion event
+                if self.last_decrease is None or sent_at>=self.last_decrease:
+                    self.last_decrease = self.last_response
+                    self.limit = max(1.0, self.limit/2)
+                    if self.rate:
+                        self.rate = max(self.max_rate/64, self.rate/2)
+                    logging.info(f"Throttled by Sisu, limiting to {int(self.limit)} concurrent requests"+
+                        (f" and {self.rate:.1f} requests/s" if self.rate else ""))
+            elif status is not None and status<400 and latency<=self.target_latency:
+                self.limit = min(float(self.max_concurrency), self.limit+1.0/self.limit)
+                if self.rate:
+                    self.rate = min(self.max_rate, self.rate+self.max_rate/50)
+            self.cond.notify_all()
+
+    def stats(self):
+        elapsed = (self.last_response-self.first_request) if self.requests else 0.0
+        throughput = self.requests/elapsed if elapsed>0 else 0.0
+        return f"Sisu requests: {self.requests} in {elapsed:.1f} s ({throughput:.1f} requests/s), "+\
+            f"{self.throttled} throttled, final limits {int(self.limit)} concurrent"+\
+            (f" and {self.rate:.1f} requests/s" if self.rate else "")
+
+class SisuFetcher:
+    """ Gets data from the Sisu API through a pooled keep-alive session.
+    Connection errors and the HTTP status codes in RETRY_STATUSES are retried
+    with an exponential backoff, or after the time the server asks for in
+    its Retry-After header. All the requests go through an
+    AdaptiveRateLimiter. """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, timeout=10.0, retries=4, backoff=0.5, max_backoff=60.0, pool_size=10, limiter=None):
+        self.limiter = limiter if limiter is not None else AdaptiveRateLimiter(max_concurrency=pool_size)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def backoff_delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff*2**attempt)
+        # jitter so that concurrent workers do not retry all at once
+        return delay*random.uniform(0.5, 1.0)
+
+    def retry_after_delay(self, resp):
+        retry_after = resp.headers.get('Retry-After')
+        if not retry_after:
+            return None
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp()-time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(self.max_backoff, max(0.0, delay))
+
+    def get(self, url, params=None, headers=None):
+        """ Returns the response or None if no response could be got. The
+        response is returned as-is when its status is not retried anymore. """
+        for attempt in range(self.retries+1):
+            last_attempt = attempt==self.retries
+            profiler.count("http_requests")
+            self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                with profiler.phase("http"):
+                    resp = self.session.get(url=url, params=params, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                self.limiter.release(None, time.monotonic()-start)
+                if last_attempt:
+                    logging.warning(f"Request to {url} failed after {attempt+1} attempts: {e}")
+                    return None
+                delay = self.backoff_delay(attempt)
+                logging.info(f"Request to {url} failed ({e}), retrying in {delay:.1f} s")
+            else:
+                self.limiter.release(resp.status_code, time.monotonic()-start)
+                logging.info("Hit SISU endpoint :"+resp.url)
+                if resp.status_code not in self.RETRY_STATUSES or last_attempt:
+                    return resp
+                delay = self.retry_after_delay(resp)
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+                logging.info(f"Got HTTP status code {resp.status_code} from {resp.url}, retrying in {delay:.1f} s")
+            profiler.count("http_retries")
+            time.sleep(delay)
+
+fetcher = SisuFetcher()
+
+class SingleFlight:
+    """ Lets concurrent callers asking for the same key share one call: the
+    first caller runs it and the others wait for and get its result (or
+    its exception). """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def do(self, key, call):
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+        if not leader:
+            profiler.count("single_flight_shared")
+            return future.result()
+
+        try:
+            result = call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+# Shared by all resolvers so that concurrent fetches of the same id to the
+#  same cache are made (and written to the cache) only once. The flights are
+#  keyed by (cache, id).
+single_flight = SingleFlight()
+# Revalidate the cached responses with conditional requests (once per run
+#  and cache, the set holds (cache, id) pairs).
+revalidate = False
+revalidated_ids = set()
+# The (cache, id) pairs of the Sisu data that does not exist (e.g. HTTP 404),
+#  unlike the data that could not be got because of a transient failure
+missing_ids = set()
+# Cache only the fields of the Sisu responses that are used (see project_response)
+projection = False
+# Also keep the full responses in this cache for debugging, if set
+raw_cache = None
+# Cache the parsed degree programmes (see CurriculumResolver.load_snapshot)
+snapshots = False
+
+def response_validators(resp):
+    """ The HTTP validators of a response for conditional requests. """
+    validators = {
+        'etag': resp.headers.get('ETag'),
+        'last_modified': resp.headers.get('Last-Modified'),
+    }
+    return {name:value for name, value in validators.items() if value}
+
+class CachePolicy:
+    """ How long the cached responses of each kind ('programme', 'module' or
+    'course') stay valid and how large the cache may grow. When it grows
+    larger, the least recently accessed entries are evicted first.
+
+    :param dict max_age: Max age in seconds per kind (missing kind is forever).
+      The backends guess the kind of the entries stored without one.
+    :param int max_bytes: Max total size of the entries (None is unlimited).
+    """
+
+    KINDS = ('programme', 'module', 'course')
+
+    def __init__(self, max_age=None, max_bytes=None):
+        self.max_age = max_age or {}
+        self.max_bytes = max_bytes
+
+    def is_expired(self, kind, fetched_at, now=None):
+        max_age = self.max_age.get(kind)
+        if max_age is None:
+            return False
+        return fetched_at<(now or time.time())-max_age
+
+def collect_garbage(backend, policy, dry_run=False):
+    """ Evicts the expired entries and then the least recently accessed
+    ones until the cache fits in policy.max_bytes. Returns the evicted
+    entries as (id, kind, size, reason) tuples. """
+    now = time.time()
+    evicted = []
+    kept = []
+    for id, kind, fetched_at, accessed_at, size in backend.entries_info():
+        if policy.is_expired(kind, fetched_at, now):
+            evicted.append( (id, kind, size, "expired") )
+        else:
+            kept.append( (accessed_at, id, kind, size) )
+    if policy.max_bytes is not None:
+        total = sum(size for _, _, _, size in kept)
+        for accessed_at, id, kind, size in sorted(kept):
+            if total<=policy.max_bytes:
+                break
+            evicted.append( (id, kind, size, "size") )
+            total-=size
+    if not dry_run:
+        for id, _, _, _ in evicted:
+            backend.delete(id)
+    return evicted
+
+def collect_garbage_on_close(backend, policy):
+    """ Shrinks a cache with a size limit to fit in it when it is closed,
+    and logs how many entries were evicted for each reason. """
+    if policy.max_bytes is None:
+        return
+    evicted = collect_garbage(backend, policy)
+    if evicted:
+        expired = sum(1 for _, _, _, reason in evicted if reason=="expired")
+        reasons = []
+        if expired:
+            reasons.append(f"{expired} expired")
+        if len(evicted)>expired:
+            reasons.append(f"{len(evicted)-expired} to keep it under {policy.max_bytes} bytes")
+        logging.info(f"Evicted {len(evicted)} entries from the cache ("+", ".join(reasons)+")")
 
-def get_cached(id):
-    full_path = path.join(cache_dir, id+'.json')
-    if path.exists(full_path):
-        with open(full_path, 'r', encoding='utf-8') as rf:
+def encode_json(data):
+    return json.dumps(data, indent=2).encode('utf-8')
+
+def encode_compact_json(data):
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+def encode_zlib(data):
+    return zlib.compress(encode_compact_json(data))
+
+def encode_msgpack(data):
+    return msgpack.packb(data)
+
+def decode_msgpack(payload):
+    return msgpack.unpackb(payload)
+
+# name: (format header byte, encode). The json codecs write plain text
+#  without a header, so that those files stay readable.
+CACHE_CODECS = {
+    'json': (None, encode_json),
+    'compact': (None, encode_compact_json),
+    'zlib': (b'Z', encode_zlib),
+    'msgpack': (b'M', encode_msgpack),
+}
+# format header byte: decode
+CODEC_DECODERS = {
+    b'Z': lambda payload: json.loads(zlib.decompress(payload)),
+    b'M': decode_msgpack,
+}
+# The compressed json blobs of the first SQLite caches had no format header,
+#  only the one of the zlib stream.
+LEGACY_ZLIB_HEADER = b'x'
+
+
+def available_codecs():
+    """ The cache codecs that can be used (msgpack only if it is installed). """
+    return [codec for codec in CACHE_CODECS if codec!='msgpack' or msgpack is not None]
+
+def check_codec(codec):
+    if codec not in CACHE_CODECS:
+        raise ValueError(f"Unknown cache codec {codec}, use one of "+", ".join(CACHE_CODECS))
+    if codec=='msgpack' and msgpack is None:
+        raise ValueError("The msgpack cache codec needs the msgpack package (pip install msgpack)")
+
+def encode_entry(data, codec):
+    """ Serializes cached data with the codec, prefixed by its format header. """
+    header, encode = CACHE_CODECS[codec]
+    if header is None:
+        return encode(data)
+    return header+encode(data)
+
+def decode_entry(blob):
+    """ Deserializes cached data written with any of the codecs. """
+    with profiler.phase("json_decode"):
+        header = blob[:1]
+        if header==LEGACY_ZLIB_HEADER:
+            return json.loads(zlib.decompress(blob))
+        if header in CODEC_DECODERS:
+            return CODEC_DECODERS[header](blob[1:])
+        return json.loads(blob)
+
+class JsonDirCache:
+    """ Stores each Sisu response as a <id>.json file in a directory, or as a
+    <id>.bin file when a binary codec is used. The kind of the response and
+    its HTTP validators, if any, are stored to <id>.meta.json. The file
+    modification time is the time the response was fetched and the access
+    time the time it was last read. """
+
+    META_SUFFIX = '.meta.json'
+    DATA_SUFFIXES = ('.json', '.bin')
+
+    DEFAULT_CODEC = 'json'
+
+    def __init__(self, cache_dir, policy=None, codec=None):
+        self.codec = codec or self.DEFAULT_CODEC
+        check_codec(self.codec)
+        self.cache_dir = cache_dir
+        self.policy = policy or CachePolicy()
+        self.suffix = '.json' if CACHE_CODECS[self.codec][0] is None else '.bin'
+        # Look for the files written with the current codec first
+        self.suffixes = sorted(self.DATA_SUFFIXES, key=lambda suffix: suffix!=self.suffix)
+        # Access times are written in bulk on close
+        self.accessed = {}
+
+    def data_path(self, id):
+        """ The file of the entry (written with any codec), None if there is none. """
+        for suffix in self.suffixes:
+            full_path = path.join(self.cache_dir, id+suffix)
+            if path.exists(full_path):
+                return full_path
+        return None
+
+    def meta_path(self, id):
+        return path.join(self.cache_dir, id+self.META_SUFFIX)
+
+    def read_meta(self, id):
+        meta_path = self.meta_path(id)
+        if not path.exists(meta_path):
+            return {}
+        with open(meta_path, 'r', encoding='utf-8') as rf:
             return json.load(rf)
-    return None
-
-def store_to_cache(this_data, with_id):
-    full_path = path.join(cache_dir, with_id+'.json')
-    with open(full_path, "w", encoding='utf-8') as wf:
-        jsonstr = json.dumps(this_data, indent=2)
-        wf.write(jsonstr)
-
-def queue_validate_and_clean_preprequisites(reqs):
-    global queued_prerequisites
-    queued_prerequisites.append( reqs )
-
-def validate_and_clean_queued_preprequisites(curriculum):
-    global queued_prerequisites
-    for reqs in queued_prerequisites:
-        to_rm = []
-        for rq in reqs:
-            if parse_course(rq, curriculum, in_main_tree=False) is None:
-                to_rm.append(rq)
-        for rmid in to_rm:
-            reqs.remove(rmid)
-
-def parse_course(cid, curriculum, in_main_tree=True):
-    global cid2c
-
-    c_data = get_cached(cid)
-    if not c_data:
-        params = {
-            'groupId':cid,
-            'universityId':'tuni-university-root-id'
-        }
-        resp = requests.get(url=SISU_COURSE_URL, params=params)
-        logging.info("Hit SISU endpoint :"+resp.url)
-        if (resp.status_code!=200):
-            logging.warning(f"Got HTTP status code {resp.status_code} when getting course with ID {cid}, skipping it.")
+
+    def entry_kind(self, id):
+        """ The kind of the entry. The kind of an entry written without one
+        (e.g. before the kinds were stored) is guessed from its data and
+        stored. """
+        meta = self.read_meta(id)
+        if not meta.get('kind'):
+            with open(self.data_path(id), 'rb') as rf:
+                meta['kind'] = guess_kind(decode_entry(rf.read()))
+            with open(self.meta_path(id), "w", encoding='utf-8') as wf:
+                json.dump(meta, wf)
+        return meta['kind']
+
+    def get(self, id, include_expired=False):
+        full_path = self.data_path(id)
+        if full_path is None:
             return None
-        
-        c_data = resp.json()
-        store_to_cache(c_data, cid)
-    
-    for c in c_data:
-        valid_for_curriculums = c['curriculumPeriodIds'] 
-        # can be empty? assume it is valid if no years is set
-        if valid_for_curriculums and not curriculum in valid_for_curriculums:
+        if self.policy.max_age and not include_expired and \
+           self.policy.is_expired(self.entry_kind(id), path.getmtime(full_path)):
+            return None
+        with open(full_path, 'rb') as rf:
+            blob = rf.read()
+        self.accessed[id] = time.time()
+        return decode_entry(blob)
+
+    def put(self, id, data, validators=None, kind=None):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        old_path = self.data_path(id)
+        full_path = path.join(self.cache_dir, id+self.suffix)
+        with open(full_path, "wb") as wf:
+            wf.write(encode_entry(data, self.codec))
+        if old_path is not None and old_path!=full_path:
+            os.remove(old_path)
+        meta = dict(validators or {})
+        if kind:
+            meta['kind'] = kind
+        meta_path = self.meta_path(id)
+        if meta:
+            with open(meta_path, "w", encoding='utf-8') as wf:
+                json.dump(meta, wf)
+        elif path.exists(meta_path):
+            os.remove(meta_path)
+
+    def get_validators(self, id):
+        meta = self.read_meta(id)
+        return {name:meta[name] for name in ('etag', 'last_modified') if name in meta}
+
+    def touch(self, id):
+        """ Marks the entry as fetched now (the file modification time). """
+        full_path = self.data_path(id)
+        if full_path is not None:
+            os.utime(full_path)
+
+    def delete(self, id):
+        for file_path in (self.data_path(id), self.meta_path(id)):
+            if file_path is not None and path.exists(file_path):
+                os.remove(file_path)
+
+    def stamps(self, ids):
+        """ Maps the ids to stamps that change whenever the entry is written,
+        None for the missing and expired entries. """
+        stamps = {}
+        for id in ids:
+            full_path = self.data_path(id)
+            if full_path is None:
+                stamps[id] = None
+                continue
+            stat = os.stat(full_path)
+            if self.policy.max_age and self.policy.is_expired(self.entry_kind(id), stat.st_mtime):
+                stamps[id] = None
+            else:
+                stamps[id] = [stat.st_mtime_ns, stat.st_size]
+        return stamps
+
+    def ids(self):
+        if not path.isdir(self.cache_dir):
+            return []
+        ids = []
+        for fn in os.listdir(self.cache_dir):
+            if fn.endswith(self.META_SUFFIX):
+                continue
+            id, suffix = path.splitext(fn)
+            if suffix in self.DATA_SUFFIXES:
+                ids.append(id)
+        return ids
+
+    def flush_access_times(self):
+        accessed, self.accessed = self.accessed, {}
+        for id, accessed_at in accessed.items():
+            full_path = self.data_path(id)
+            if full_path is not None:
+                # keep the modification time exactly as it is, it is in the stamps
+                os.utime(full_path, ns=(int(accessed_at*1e9), os.stat(full_path).st_mtime_ns))
+
+    def entries_info(self):
+        """ Yields (id, kind, fetched_at, accessed_at, size) of each entry. """
+        self.flush_access_times()
+        for id in self.ids():
+            stat = os.stat(self.data_path(id))
+            size = stat.st_size
+            if path.exists(self.meta_path(id)):
+                size+=os.stat(self.meta_path(id)).st_size
+            yield id, self.entry_kind(id), stat.st_mtime, stat.st_atime, size
+
+    def close(self):
+        self.flush_access_times()
+        collect_garbage_on_close(self, self.policy)
+
+class SqliteCache:
+    """ Stores all Sisu responses into a single SQLite database file. The
+    responses are stored encoded with the codec (by default zlib compressed
+    compact json) together with their kind, their HTTP validators and the
+    times they were fetched and last read. """
+
+    DEFAULT_FILE_NAME = "sisu_cache.sqlite"
+    DEFAULT_CODEC = 'zlib'
+
+    def __init__(self, db_path, policy=None, codec=None):
+        self.codec = codec or self.DEFAULT_CODEC
+        check_codec(self.codec)
+        if path.isdir(db_path) or db_path.endswith(('/', os.sep)):
+            db_path = path.join(db_path, self.DEFAULT_FILE_NAME)
+        if path.dirname(db_path):
+            os.makedirs(path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.policy = policy or CachePolicy()
+        # Access times are written in bulk on close
+        self.accessed = {}
+        # The crawler uses the cache from many threads, serialize the access.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+            "id TEXT PRIMARY KEY, data BLOB NOT NULL, fetched_at REAL NOT NULL)")
+        self.add_missing_columns()
+
+    # Columns added after the first version of the schema
+    LATER_COLUMNS = [
+        ("etag", "TEXT"),
+        ("last_modified", "TEXT"),
+        ("kind", "TEXT"),
+        ("accessed_at", "REAL"),
+    ]
+
+    def add_missing_columns(self):
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(responses)")}
+        for column, column_type in self.LATER_COLUMNS:
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE responses ADD COLUMN {column} {column_type}")
+
+    def guess_missing_kind(self, id, blob=None):
+        """ Guesses the kind of an entry written without one (e.g. before
+        the kinds were stored) from its data and stores it. """
+        with self.lock:
+            if blob is None:
+                blob = self.conn.execute("SELECT data FROM responses WHERE id=?", (id,)).fetchone()[0]
+            kind = guess_kind(decode_entry(blob))
+            self.conn.execute("UPDATE responses SET kind=? WHERE id=?", (kind, id))
+        return kind
+
+    def get(self, id, include_expired=False):
+        with self.lock:
+            row = self.conn.execute("SELECT data, fetched_at, kind FROM responses WHERE id=?", (id,)).fetchone()
+        if row is None:
+            return None
+        blob, fetched_at, kind = row
+        if self.policy.max_age and not kind:
+            kind = self.guess_missing_kind(id, blob)
+        if not include_expired and self.policy.is_expired(kind, fetched_at):
+            return None
+        self.accessed[id] = time.time()
+        return decode_entry(blob)
+
+    def put(self, id, data, validators=None, kind=None):
+        blob = encode_entry(data, self.codec)
+        validators = validators or {}
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses "+
+                "(id, data, fetched_at, etag, last_modified, kind, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (id, blob, now, validators.get('etag'), validators.get('last_modified'), kind, now))
+
+    def get_validators(self, id):
+        with self.lock:
+            row = self.conn.execute("SELECT etag, last_modified FROM responses WHERE id=?", (id,)).fetchone()
+        if row is None:
+            return {}
+        return {name:value for name, value in zip(('etag', 'last_modified'), row) if value}
+
+    def touch(self, id):
+        with self.lock:
+            self.conn.execute("UPDATE responses SET fetched_at=? WHERE id=?", (time.time(), id))
+
+    def delete(self, id):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses WHERE id=?", (id,))
+
+    def stamps(self, ids):
+        """ Maps the ids to stamps that change whenever the entry is written,
+        None for the missing and expired entries. """
+        ids = list(ids)
+        stamps = dict.fromkeys(ids)
+        # stay under the SQLite limit of query parameters
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            with self.lock:
+                rows = self.conn.execute("SELECT id, fetched_at, kind FROM responses WHERE id IN (%s)"%
+                    ",".join("?"*len(chunk)), chunk).fetchall()
+            for id, fetched_at, kind in rows:
+                if self.policy.max_age and not kind:
+                    kind = self.guess_missing_kind(id)
+                if not self.policy.is_expired(kind, fetched_at):
+                    stamps[id] = fetched_at
+        return stamps
+
+    def ids(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT id FROM responses")]
+
+    def flush_access_times(self):
+        accessed, self.accessed = self.accessed, {}
+        with self.lock:
+            self.conn.executemany("UPDATE responses SET accessed_at=? WHERE id=?",
+                [(accessed_at, id) for id, accessed_at in accessed.items()])
+
+    def entries_info(self):
+        """ Yields (id, kind, fetched_at, accessed_at, size) of each entry. """
+        self.flush_access_times()
+        with self.lock:
+            rows = self.conn.execute("SELECT id, kind, fetched_at, COALESCE(accessed_at, fetched_at), "+
+                "length(data) FROM responses").fetchall()
+        return [(id, kind or self.guess_missing_kind(id), fetched_at, accessed_at, size)
+            for id, kind, fetched_at, accessed_at, size in rows]
+
+    def close(self):
+        self.flush_access_times()
+        collect_garbage_on_close(self, self.policy)
+        with self.lock:
+            self.conn.close()
+
+def index_versions(versions):
+    """ Maps each curriculum period id to the versions in a Sisu response
+    that are valid for it, in their original order. Versions without any
+    periods set are assumed to be valid for all curriculums. These are
+    in every list and alone under the key None. """
+    index = {None: []}
+    for version in versions:
+        if not version['curriculumPeriodIds']:
+            for valid_versions in index.values():
+                valid_versions.append(version)
             continue
+        for curriculum in dict.fromkeys(version['curriculumPeriodIds']):
+            if curriculum not in index:
+                index[curriculum] = list(index[None])
+            index[curriculum].append(version)
+    return index
 
-        code = c['code']
-        if 'fi' in c['name']:
-            name = c['name']['fi']
-        else:
-            name = c['name']['en']
+class MemoCache:
+    """ A bounded in-memory LRU tier in front of another cache, so that each
+    response is read and deserialized at most once per process (as long as
+    it fits). The returned data is shared and must not be modified. The
+    curriculum index of each response is also built here only once. """
 
-        rprqs = []
-        for prs in c['recommendedFormalPrerequisites']:
-            for pr in prs['prerequisites']:
-                if pr['type']!='CourseUnit':
-                    logging.warning("Skipping non-course prerequisite")
-                    continue
-                if pr['courseUnitGroupId'] not in rprqs:
-                    rprqs.append(pr['courseUnitGroupId'])
-
-        cprqs = []
-        for prs in c['compulsoryFormalPrerequisites']:
-            for pr in prs['prerequisites']:
-                if pr['type']!='CourseUnit':
-                    logging.warning("Skipping non-course prerequisite")
-                    continue
-                if pr['courseUnitGroupId'] not in rprqs:
-                    cprqs.append(pr['courseUnitGroupId'])
-
-        course = {'code':code, 'name':name, 'rec_prqs':rprqs, 'com_prqs':cprqs}
-
-        course['key'] = c['code'].replace(".", "_")
-        # Sometimes the course may be in alternative module groups. Create a new key!
-        #  TODO: What if it is in 3 groups?
-        if in_main_tree and cid in cid2c:
-            course['key']+="_alt"
-        cid2c[cid] = course
-        return course
-    return None
-
-def parse_module_group(gid, curriculum):
-    """ Parses module group type data in the Sisu data. """
-    sm_data = get_cached(gid)
-    if not sm_data:
-        params = {
-            'groupId':gid,
-            'universityId':'tuni-university-root-id'
-        }
-        resp = requests.get(url=SISU_GROUP_URL, params=params)
-        logging.info("Hit SISU endpoint :"+resp.url)
+    def __init__(self, backend, max_entries=4096):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.indices = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def remember(self, id, data):
+        if self.entries.get(id) is not data:
+            self.indices.pop(id, None)
+        self.entries[id] = data
+        self.entries.move_to_end(id)
+        while len(self.entries)>self.max_entries:
+            evicted_id, _ = self.entries.popitem(last=False)
+            self.indices.pop(evicted_id, None)
+
+    def version_index(self, id, data):
+        """ Returns index_versions of the response data got with the id. """
+        with self.lock:
+            index = self.indices.get(id)
+            if index is not None and self.entries.get(id) is data:
+                return index
+        index = index_versions(data)
+        with self.lock:
+            if self.entries.get(id) is data:
+                self.indices[id] = index
+        return index
+
+    def get(self, id, include_expired=False):
+        with self.lock:
+            if id in self.entries:
+                profiler.count("memo_hits")
+                self.hits+=1
+                self.entries.move_to_end(id)
+                return self.entries[id]
+        with profiler.phase("cache_read"):
+            data = self.backend.get(id, include_expired)
+        with self.lock:
+            self.misses+=1
+            if data is not None:
+                self.remember(id, data)
+        return data
+
+    def put(self, id, data, validators=None, kind=None):
+        with profiler.phase("cache_write"):
+            self.backend.put(id, data, validators, kind)
+        with self.lock:
+            self.remember(id, data)
+
+    def get_validators(self, id):
+        return self.backend.get_validators(id)
+
+    def touch(self, id):
+        self.backend.touch(id)
+
+    def delete(self, id):
+        with self.lock:
+            self.entries.pop(id, None)
+            self.indices.pop(id, None)
+        self.backend.delete(id)
+
+    def stamps(self, ids):
+        return self.backend.stamps(ids)
+
+    def ids(self):
+        return self.backend.ids()
+
+    def entries_info(self):
+        return self.backend.entries_info()
+
+    def close(self):
+        self.backend.close()
+
+    def stats(self):
+        lookups = self.hits+self.misses
+        hit_rate = 100.0*self.hits/lookups if lookups else 0.0
+        return f"In-memory cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), {len(self.entries)}/{self.max_entries} entries"
+
+CACHE_BACKENDS = {
+    'json': JsonDirCache,
+    'sqlite': SqliteCache,
+}
+
+def open_cache(backend='json', location=None, policy=None, codec=None):
+    """ Opens a cache backend. The location is the cache directory for the
+    json backend and the database file (or its directory) for sqlite. The
+    codec (see CACHE_CODECS) is used to write the entries, the entries
+    written with the other codecs can still be read. By default the json
+    backend writes indented json and sqlite zlib compressed json. """
+    if location is None:
+        location = cache_dir
+    return CACHE_BACKENDS[backend](location, policy, codec)
+
+def migrate_cache(from_cache, to_cache, project=False):
+    """ Copies all the entries of one cache to another, returns their count.
+    With project, only the used fields are copied (see project_response). """
+    count = 0
+    for id, kind, _, _, _ in list(from_cache.entries_info()):
+        data = from_cache.get(id, include_expired=True)
+        if data is not None:
+            kind = kind or guess_kind(data)
+            if project and kind in PROJECTED_FIELDS:
+                data = project_response(kind, data)
+            to_cache.put(id, data, from_cache.get_validators(id), kind)
+            count+=1
+    return count
+
+cache = MemoCache(JsonDirCache(cache_dir))
+
+def group_params(gid):
+    return {
+        'groupId':gid,
+        'universityId':'tuni-university-root-id'
+    }
+
+def referenced_group_ids(rd):
+    """ Lists the (kind, id) of all modules and courses referenced anywhere
+    in the rule tree. """
+    found = []
+    stack = [rd]
+    while stack:
+        rule = stack.pop()
+        if 'moduleGroupId' in rule:
+            found.append( ('module', rule['moduleGroupId']) )
+        elif 'courseUnitGroupId' in rule:
+            found.append( ('course', rule['courseUnitGroupId']) )
+        if rule.get('rule'):
+            stack.append(rule['rule'])
+        if rule.get('rules'):
+            stack.extend(reversed(rule['rules']))
+    return found
+
+# The fields of the Sisu responses that are used, see project_response
+PROJECTED_FIELDS = {
+    'programme': ('id', 'code', 'name', 'type', 'curriculumPeriodIds', 'rule'),
+    'module': ('id', 'groupId', 'code', 'name', 'type', 'curriculumPeriodIds', 'rule'),
+    'course': ('id', 'groupId', 'code', 'name', 'curriculumPeriodIds',
+               'recommendedFormalPrerequisites', 'compulsoryFormalPrerequisites'),
+}
+PROJECTED_RULE_FIELDS = ('type', 'allMandatory', 'moduleGroupId', 'courseUnitGroupId')
+PROJECTED_LANGUAGES = ('fi', 'en')
+
+def project_text(text):
+    return {lang:text[lang] for lang in PROJECTED_LANGUAGES if lang in text}
+
+def project_rule(rd):
+    rule = {name:rd[name] for name in PROJECTED_RULE_FIELDS if name in rd}
+    if rd.get('description'):
+        rule['description'] = project_text(rd['description'])
+    if rd.get('rule'):
+        rule['rule'] = project_rule(rd['rule'])
+    if 'rules' in rd:
+        rule['rules'] = [project_rule(child) for child in rd['rules']]
+    return rule
+
+def project_prerequisites(prerequisite_groups):
+    return [{'prerequisites':[{name:pr[name] for name in ('type', 'courseUnitGroupId') if name in pr}
+                              for pr in prs['prerequisites']]}
+            for prs in prerequisite_groups]
+
+def project_version(kind, version):
+    projected = {}
+    for name in PROJECTED_FIELDS[kind]:
+        if name not in version:
+            continue
+        value = version[name]
+        if name=='name':
+            value = project_text(value)
+        elif name=='rule':
+            value = project_rule(value)
+        elif name.endswith('FormalPrerequisites'):
+            value = project_prerequisites(value)
+        projected[name] = value
+    return projected
+
+def project_response(kind, data):
+    """ Trims a Sisu response of the kind ('programme', 'module' or 'course')
+    to the fields this script reads: descriptions, learning outcomes and
+    other metadata are dropped and the texts are kept only in Finnish and
+    English. Projecting a projected response returns it as it is. """
+    if kind=='programme':
+        return project_version(kind, data)
+    return [project_version(kind, version) for version in data]
+
+def guess_kind(data):
+    """ The kind of a cached response stored without one. """
+    if isinstance(data, dict):
+        return 'programme'
+    if any('rule' in version for version in data):
+        return 'module'
+    return 'course'
+
+class CurriculumResolver:
+    """ Resolves the module hierarchy and the courses of a degree programme
+    for one curriculum. The resolver owns the per-graph state (the course map
+    and the prerequisites queued for validation) while the cache and the
+    fetcher can be shared by many resolvers, so that programmes can be
+    resolved back-to-back or concurrently in one process.
+
+    :param str curriculum: The curriculum code to use (e.g. "uta-lvv-2022").
+    :param MemoCache response_cache: The cache for the Sisu responses (default: the module cache).
+    :param sisu_fetcher: The SisuFetcher to use (default: the module fetcher).
+    :param bool revalidate_cached: Check with Sisu if the cached responses have
+      changed (default: the module revalidate flag).
+    :param bool project_responses: Cache only the used fields of the responses
+      (default: the module projection flag).
+    :param bool use_snapshots: Cache the parsed programmes (default: the
+      module snapshots flag).
+    """
+
+    def __init__(self, curriculum, response_cache=None, sisu_fetcher=None, revalidate_cached=None,
+                 project_responses=None, use_snapshots=None):
+        self.curriculum = curriculum
+        self.revalidate = revalidate_cached if revalidate_cached is not None else revalidate
+        self.project = project_responses if project_responses is not None else projection
+        # The snapshot could hide the changes revalidation would find
+        self.use_snapshots = (use_snapshots if use_snapshots is not None else snapshots) and not self.revalidate
+        self.cache = response_cache if response_cache is not None else cache
+        self.fetcher = sisu_fetcher if sisu_fetcher is not None else fetcher
+        # Map course id/code to course data
+        self.cid2c = {}
+        # Prerequisites waiting for processing
+        self.queued_prerequisites = []
+        # Ids of all the Sisu data the resolver has read
+        self.used_ids = set()
+
+    def fetch(self, url, id, kind, what, params=None):
+        """ Gets the data with the id from the Sisu API and stores it to the
+        cache as the kind. Returns None if the request was not successful. """
+        resp = self.fetcher.get(url, params)
+        if resp is None:
+            logging.warning(f"Could not get {what} ID {id}, skipping it.")
+            profiler.count("fetch_failures")
+            return None
         if (resp.status_code!=200):
-            logging.warning(f"Got HTTP status code {resp.status_code} when getting degree module ID {gid}, skipping it.")
+            logging.warning(f"Got HTTP status code {resp.status_code} when getting {what} ID {id}, skipping it.")
+            profiler.count("fetch_failures")
+            if resp.status_code not in SisuFetcher.RETRY_STATUSES:
+                missing_ids.add( (self.cache, id) )
             return None
 
-        sm_data = resp.json()
-        store_to_cache(sm_data, gid)
+        data = self.decode_response(resp, id, kind)
+        self.cache.put(id, data, response_validators(resp), kind)
+        return data
+
+    def decode_response(self, resp, id, kind):
+        """ The data of a successful response, projected if so configured. """
+        with profiler.phase("json_decode"):
+            data = resp.json()
+        if raw_cache is not None:
+            raw_cache.put(id, data, response_validators(resp), kind)
+        if self.project:
+            data = project_response(kind, data)
+        return data
+
+    def revalidate_entry(self, id, kind, data, url, what, params=None):
+        """ Asks Sisu with a conditional request if the cached data has
+        changed. Rewrites the cache entry only if it has, and keeps using the
+        cached data if Sisu can not be reached. """
+        if (self.cache, id) in revalidated_ids:
+            return self.cache.get(id) or data
+        validators = self.cache.get_validators(id)
+        headers = {}
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        resp = self.fetcher.get(url, params, headers)
+        if resp is None or resp.status_code not in (200, 304):
+            status = resp.status_code if resp is not None else "no response"
+            logging.warning(f"Could not revalidate {what} ID {id} ({status}), using the cached data.")
+        elif resp.status_code==304:
+            profiler.count("revalidated_unchanged")
+            self.cache.touch(id)
+        else:
+            new_data = self.decode_response(resp, id, kind)
+            if self.project:
+                # the cached data may be from before the projection was enabled
+                data = project_response(kind, data)
+            if new_data==data:
+                profiler.count("revalidated_unchanged")
+                new_validators = response_validators(resp)
+                if new_validators!=validators:
+                    self.cache.put(id, data, new_validators, kind)
+                else:
+                    self.cache.touch(id)
+            else:
+                profiler.count("revalidated_changed")
+                logging.info(f"The {what} ID {id} has changed in Sisu")
+                self.cache.put(id, new_data, response_validators(resp), kind)
+                data = new_data
+        revalidated_ids.add( (self.cache, id) )
+        return data
+
+    def get_or_fetch(self, id, kind, url, what, params=None):
+        """ Gets the data with the id from the cache or, if it is not there
+        (or has expired), from Sisu. Concurrent fetches of the same id to the
+        same cache share one request. """
+        self.used_ids.add(id)
+        data = self.cache.get(id)
+        if data and self.revalidate and (self.cache, id) not in revalidated_ids:
+            data = single_flight.do((self.cache, id), lambda: self.revalidate_entry(id, kind, data, url, what, params))
+        elif not data:
+            def fetch_once():
+                # it may have been fetched while waiting for the lock
+                return self.cache.get(id) or self.fetch(url, id, kind, what, params)
+            data = single_flight.do((self.cache, id), fetch_once)
+            if not data:
+                data = self.cache.get(id, include_expired=True)
+                if data:
+                    logging.warning(f"Using expired cached data for {what} ID {id}.")
+        return data
+
+    def get_programme(self, pgid):
+        return self.get_or_fetch(pgid, 'programme', SISU_PROG_URL+pgid, "degree programme")
+
+    def get_module_group(self, gid):
+        return self.get_or_fetch(gid, 'module', SISU_GROUP_URL, "degree module", group_params(gid))
+
+    def get_course(self, cid):
+        return self.get_or_fetch(cid, 'course', SISU_COURSE_URL, "course with", group_params(cid))
+
+    def valid_versions(self, id, data, curriculum=None):
+        """ The versions in the response data that are valid for the curriculum
+        (by default the one of the resolver). """
+        index = self.cache.version_index(id, data)
+        return index.get(curriculum or self.curriculum, index[None])
+
+    def crawl_group(self, kind, gid, curriculums):
+        """ Makes sure the data of a module or a course is in the cache and
+        returns the (kind, id) of the groups it refers to in any of the
+        curriculums. Prerequisite courses are fetched, but their own
+        prerequisites are not followed. """
+        if kind=='module':
+            data = self.get_module_group(gid)
+        else:
+            data = self.get_course(gid)
+        if not data:
+            return []
+
+        found = []
+        for curriculum in curriculums:
+            for version in self.valid_versions(gid, data, curriculum):
+                if kind=='module':
+                    found+=referenced_group_ids(version['rule'])
+                elif kind=='course':
+                    for prs in version['recommendedFormalPrerequisites']+\
+                               version['compulsoryFormalPrerequisites']:
+                        for pr in prs['prerequisites']:
+                            if pr['type']=='CourseUnit':
+                                found.append( ('prerequisite', pr['courseUnitGroupId']) )
+                    # parse_course only uses the first valid version
+                    break
+        return found
+
+    def crawl(self, p_data, workers=8, curriculums=None):
+        """ Prefetches all the modules and courses of a degree programme to the
+        cache. The tree is crawled breadth-first and each level is fetched
+        concurrently with a pool of workers, so with a cold cache the time taken
+        depends on the depth of the tree and not on the number of its nodes.
+        With curriculums, the groups of all of them are fetched in one crawl.
+        Returns the number of the groups crawled. """
+        if not curriculums:
+            curriculums = [self.curriculum]
+        frontier = referenced_group_ids(p_data['rule'])
+        seen = {}
+        level = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while frontier:
+                to_crawl = []
+                for kind, gid in frontier:
+                    # A course seen earlier only as a prerequisite has to be
+                    #  crawled again to follow its own prerequisites.
+                    if gid in seen and (seen[gid]!='prerequisite' or kind=='prerequisite'):
+                        continue
+                    seen[gid] = kind
+                    to_crawl.append( (kind, gid) )
+                if not to_crawl:
+                    break
+                logging.info(f"Crawling level {level} with {len(to_crawl)} modules and courses")
+
+                frontier = []
+                for found in pool.map(lambda kg: self.crawl_group(*kg, curriculums), to_crawl):
+                    frontier+=found
+                level+=1
+        return len(seen)
+
+    def queue_validate_and_clean_preprequisites(self, reqs):
+        self.queued_prerequisites.append( reqs )
+
+    def validate_and_clean_queued_preprequisites(self):
+        """ Removes the prerequisites that are not courses valid for the
+        curriculum. Each unique prerequisite id is parsed only once and the
+        queued lists are then filtered in a single pass. """
+        # dict keeps the ids in the order they were first seen
+        unique_ids = dict.fromkeys(rq for reqs in self.queued_prerequisites for rq in reqs)
+        valid_ids = {rq for rq in unique_ids if self.parse_course(rq, in_main_tree=False) is not None}
+        for reqs in self.queued_prerequisites:
+            reqs[:] = [rq for rq in reqs if rq in valid_ids]
+
+    def parse_course(self, cid, in_main_tree=True):
+        c_data = self.get_course(cid)
+        if not c_data:
+            return None
     
-    for alt_grouping in sm_data:
-        valid_for_curriculums = alt_grouping['curriculumPeriodIds'] 
-        # can be empty? assume it is valid if no years is set
-        if valid_for_curriculums and not curriculum in valid_for_curriculums:
-            continue
+        for c in self.valid_versions(cid, c_data):
 
-        name = alt_grouping['name']['fi']
-        type = alt_grouping['type']
-        
-        node = {'name':name, 'type':type, 'children':[]}
-        node['children'] = parse_rules(alt_grouping['rule'], curriculum)
-        if not node['children']: 
-            continue
-        return node
-    return None
-
-def parse_rules(rd, curriculum):
-    """ Recursively parses rules, modules, and courses in the Sisu data. """
-    type = rd['type']
-    if type=='CreditsRule': 
-        # ignore credits info for now, just recurese into child
-        return parse_rules(rd['rule'], curriculum)
-    elif type=='CompositeRule':
-        children = []
-        for rule in rd['rules']:
-            if 'moduleGroupId' in rule:
-                gid = rule['moduleGroupId']
-                gmg = parse_module_group(gid, curriculum)
-                if gmg:
-                    children.append(gmg)
-            elif 'courseUnitGroupId' in rule:
-                cid = rule['courseUnitGroupId']
-                course = parse_course(cid, curriculum)
-                if course is not None:
-                    queue_validate_and_clean_preprequisites(course['rec_prqs'])
-                    queue_validate_and_clean_preprequisites(course['com_prqs'])
-                    children.append(course)
+            code = c['code']
+            if 'fi' in c['name']:
+                name = c['name']['fi']
             else:
-                name = ''
-                type = 'grouping'
-                if 'description' in rule and rule['description']:
-                    name = rule['description']['fi'].strip().strip("<p>").strip("</p>")
-                elif 'allMandatory' in rule and rule['allMandatory']:
-                    name = 'Pakolliset'
-
-                node = {'name':name, 'type':type, 'children':[]}
-                node['children'] = parse_rules(rule, curriculum)
-                if node['children']:
-                    children.append(node)
-        if not children:
+                name = c['name']['en']
+
+            rprqs = []
+            for prs in c['recommendedFormalPrerequisites']:
+                for pr in prs['prerequisites']:
+                    if pr['type']!='CourseUnit':
+                        logging.warning("Skipping non-course prerequisite")
+                        continue
+                    if pr['courseUnitGroupId'] not in rprqs:
+                        rprqs.append(pr['courseUnitGroupId'])
+
+            cprqs = []
+            for prs in c['compulsoryFormalPrerequisites']:
+                for pr in prs['prerequisites']:
+                    if pr['type']!='CourseUnit':
+                        logging.warning("Skipping non-course prerequisite")
+                        continue
+                    if pr['courseUnitGroupId'] not in rprqs:
+                        cprqs.append(pr['courseUnitGroupId'])
+
+            course = {'code':code, 'name':name, 'rec_prqs':rprqs, 'com_prqs':cprqs}
+
+            course['key'] = c['code'].replace(".", "_")
+            # Sometimes the course may be in alternative module groups. Create a new key!
+            #  TODO: What if it is in 3 groups?
+            if in_main_tree and cid in self.cid2c:
+                course['key']+="_alt"
+            self.cid2c[cid] = course
+            return course
+        return None
+
+    def parse_module_group(self, gid):
+        """ Parses module group type data in the Sisu data. """
+        sm_data = self.get_module_group(gid)
+        if not sm_data:
             return None
-        return children
-    elif type=='CourseUnitRule':
-        cid = rule['courseUnitGroupId']
-        course = parse_course(cid, curriculum)
-        if course is None:
+    
+        for alt_grouping in self.valid_versions(gid, sm_data):
+
+            name = alt_grouping['name']['fi']
+            type = alt_grouping['type']
+        
+            node = {'name':name, 'type':type, 'id':gid, 'children':[]}
+            node['children'] = self.parse_rules(alt_grouping['rule'])
+            if not node['children']: 
+                continue
+            return node
+        return None
+
+    def parse_rules(self, rd):
+        """ Recursively parses rules, modules, and courses in the Sisu data. """
+        type = rd['type']
+        if type=='CreditsRule': 
+            # ignore credits info for now, just recurese into child
+            return self.parse_rules(rd['rule'])
+        elif type=='CompositeRule':
+            children = []
+            for rule in rd['rules']:
+                if 'moduleGroupId' in rule:
+                    gid = rule['moduleGroupId']
+                    gmg = self.parse_module_group(gid)
+                    if gmg:
+                        children.append(gmg)
+                elif 'courseUnitGroupId' in rule:
+                    cid = rule['courseUnitGroupId']
+                    course = self.parse_course(cid)
+                    if course is not None:
+                        self.queue_validate_and_clean_preprequisites(course['rec_prqs'])
+                        self.queue_validate_and_clean_preprequisites(course['com_prqs'])
+                        children.append(course)
+                else:
+                    name = ''
+                    type = 'grouping'
+                    if 'description' in rule and rule['description']:
+                        name = rule['description']['fi'].strip().strip("<p>").strip("</p>")
+                    elif 'allMandatory' in rule and rule['allMandatory']:
+                        name = 'Pakolliset'
+
+                    node = {'name':name, 'type':type, 'children':[]}
+                    node['children'] = self.parse_rules(rule)
+                    if node['children']:
+                        children.append(node)
+            if not children:
+                return None
+            return children
+        elif type=='CourseUnitRule':
+            cid = rd['courseUnitGroupId']
+            course = self.parse_course(cid)
+            if course is None:
+                return None
+            self.queue_validate_and_clean_preprequisites(course['rec_prqs'])
+            self.queue_validate_and_clean_preprequisites(course['com_prqs'])
+            return course 
+        else:
+            print("WARNING: unknown type ", type)
+        return None
+
+    def parse_programme(self, p_data):
+        """ Parses the modules of the degree programme data into a list. """
+        module_hierarchy = []
+        # TODO: make this more robust and smart as this probably assumes too much
+        #  of the degree program structure of the rules.
+        for submodule in p_data['rule']['rules'][0]['rules']:
+            gid = submodule['moduleGroupId']
+            smg =  self.parse_module_group(gid)
+            if smg:
+                module_hierarchy.append(smg)
+        return module_hierarchy
+
+    SNAPSHOT_FORMAT = 4
+
+    def snapshot_id(self, pgid):
+        return f"snapshot-{pgid}-{self.curriculum}"
+
+    def inputs_key(self, ids, missing=()):
+        """ Hash of the cache entries with the ids, None if any is missing.
+        The ids in missing are expected to be missing, their absence is part
+        of the hash. """
+        stamps = self.cache.stamps(ids)
+        for id in missing:
+            if stamps.get(id) is None:
+                stamps[id] = "missing"
+        if None in stamps.values():
             return None
-        queue_validate_and_clean_preprequisites(course['rec_prqs'])
-        queue_validate_and_clean_preprequisites(course['com_prqs'])
-        return course 
-    else:
-        print("WARNING: unknown type ", type)
-    return None
+        inputs = json.dumps([self.SNAPSHOT_FORMAT, sorted(stamps.items())])
+        return hashlib.sha256(inputs.encode('utf-8')).hexdigest()
+
+    def load_snapshot(self, pgid):
+        """ Returns the module hierarchy stored by save_snapshot, if none of
+        the cached Sisu data it was parsed from has changed since. Sets
+        cid2c and used_ids as resolving would. """
+        snapshot = self.cache.get(self.snapshot_id(pgid))
+        if not snapshot or snapshot['format']!=self.SNAPSHOT_FORMAT or \
+           self.inputs_key(snapshot['inputs'], snapshot['missing'])!=snapshot['key']:
+            return None
+        # like all the cached data, these are shared and must not be modified
+        self.cid2c = snapshot['cid2c']
+        self.used_ids = set(snapshot['inputs'])
+        return snapshot['module_hierarchy']
+
+    def save_snapshot(self, pgid, module_hierarchy):
+        missing = sorted(id for id in self.used_ids if (self.cache, id) in missing_ids)
+        key = self.inputs_key(self.used_ids, missing)
+        if key is None:
+            # some data could not be got for now, do not make it permanent
+            logging.info(f"Not saving a snapshot of {pgid}, some of its Sisu data could not be got")
+            return
+        self.cache.put(self.snapshot_id(pgid), {
+            'format': self.SNAPSHOT_FORMAT,
+            'key': key,
+            'inputs': sorted(self.used_ids),
+            'missing': missing,
+            'module_hierarchy': module_hierarchy,
+            'cid2c': self.cid2c,
+        }, kind='snapshot')
+
+    def resolve(self, pgid, workers=8):
+        """ Fetches the degree programme (from Sisu or from cache) and returns
+        its compressed module hierarchy, or None if it could not be got. The
+        courses are stored in cid2c. With snapshots, a programme parsed
+        earlier from the same cached data is returned without crawling and
+        parsing it again. """
+        if self.use_snapshots:
+            with profiler.phase("snapshot"):
+                module_hierarchy = self.load_snapshot(pgid)
+            if module_hierarchy is not None:
+                profiler.count("snapshot_hits")
+                profiler.count("courses", len(self.cid2c))
+                return module_hierarchy
+
+        p_data = self.get_programme(pgid)
+        if not p_data:
+            return None
+
+        if workers:
+            with profiler.phase("crawl"):
+                self.crawl(p_data, workers)
+
+        with profiler.phase("parse_rules"):
+            module_hierarchy = self.parse_programme(p_data)
+        # Process the prerequisites now that we know all the ids
+        with profiler.phase("validate"):
+            self.validate_and_clean_queued_preprequisites()
+
+        # This removes/shrinks/combines unnecessary rules for visualization such as
+        #  credit rules, groupings etc.
+        with profiler.phase("compress"):
+            compress(module_hierarchy)
+        profiler.count("courses", len(self.cid2c))
+        if self.use_snapshots:
+            with profiler.phase("snapshot"):
+                self.save_snapshot(pgid, module_hierarchy)
+        return module_hierarchy
 
 def compress(hierarchy):
     """ Compresses the module/course hierachy by removing useless (for the
-    graph!) information such as groupings etc."""
+    graph!) information such as groupings etc. A promoted grouping (that
+    has no id) gets the id of the module it replaces. """
     replacements = []
     for g in hierarchy:
         if 'children' in g and len(g['children'])==1:
             only_child = g['children'][0]
             if 'children' in only_child:
                 #only_child['name'] = g['name']+"/"+only_child['name']
+                if not only_child.get('id'):
+                    only_child = dict(only_child, id=g.get('id'))
                 replacements.append( (g, only_child) )
     for this, that in replacements:
         ti = hierarchy.index(this)
         hierarchy[ti]=that
 
+CURRICULUM_CODE = "uta-lvv-%d"
+
+def cyclic_nodes(successors):
+    """ The nodes that are in a cycle of the graph given as a dict of
+    successor lists (iterative Tarjan's algorithm). """
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    cyclic = set()
+    for root in successors:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors.get(root, ())))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors.get(child, ()))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node]==index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member==node:
+                            break
+                    if len(component)>1 or node in successors.get(node, ()):
+                        cyclic.update(component)
+    return cyclic
+
+def redundant_edges(edges):
+    """ The (from, to) edges implied by a longer path in the graph, i.e. the
+    ones the transitive reduction removes. The edges touching nodes in a
+    cycle are kept. The nodes reachable from each node are collected in
+    reverse topological order as bitsets (ints), so an edge u->v is
+    redundant if v can be reached from another successor of u. """
+    successors = {}
+    for from_c, to_c in edges:
+        successors.setdefault(from_c, set()).add(to_c)
+    cyclic = cyclic_nodes(successors)
+    dag = {from_c:[to_c for to_c in to_cs if to_c not in cyclic]
+           for from_c, to_cs in successors.items() if from_c not in cyclic}
+
+    # Kahn's algorithm
+    in_degree = {}
+    for to_cs in dag.values():
+        for to_c in to_cs:
+            in_degree[to_c] = in_degree.get(to_c, 0)+1
+    order = [node for node in dag if node not in in_degree]
+    for node in order:
+        for to_c in dag.get(node, ()):
+            in_degree[to_c]-=1
+            if in_degree[to_c]==0:
+                order.append(to_c)
+    bit = {node:1<<i for i, node in enumerate(order)}
+
+    reach = {}
+    redundant = set()
+    for node in reversed(order):
+        to_cs = dag.get(node, ())
+        via = 0
+        for to_c in to_cs:
+            via|=reach[to_c]
+        for to_c in to_cs:
+            if via&bit[to_c]:
+                redundant.add( (node, to_c) )
+        node_reach = via
+        for to_c in to_cs:
+            node_reach|=bit[to_c]
+        reach[node] = node_reach
+    return redundant
+
+class GvWriter:
+    """ Writes a resolved module hierarchy and its courses as a graphviz
+    graph. The output is built in a buffer and written out in one go. See
+    draw_graph_for_degree_programme for the parameters. This does not need
+    the cache or Sisu, and can thus be run in another process.
+
+    In the canonical mode the output only depends on the content of the
+    graph: the clusters are named after the module ids (the groupings
+    after their module and name) instead of running numbers, and the
+    prerequisite edges and the loose courses are sorted and deduplicated.
+
+    With reduce_edges ('style' or 'all') the prerequisite edges are
+    transitively reduced, see reduce. """
+
+    def __init__(self, cid2c, also_recommended=True, course_blacklist=[], extra_data={}, canonical=False,
+                 reduce_edges=None):
+        self.cid2c = cid2c
+        self.canonical = canonical
+        self.reduce_edges = reduce_edges
+        self.edges_before = 0
+        self.edges_removed = 0
+        self.also_recommended = also_recommended
+        self.course_blacklist = {cc.replace(".","_") for cc in course_blacklist or []}
+        self.extra_data = extra_data
+        self.course_icons = extra_data['course_icons'] if extra_data else {}
+        self.buffer = io.StringIO()
+        self.sgidx = 1
+        self.cluster_ids = set()
+        self.indent = 0
+        self.in_clusters = set()
+        self.all_com_prqs = []
+        self.all_rec_prqs = []
+
+    def write_course(self, c):
+        w = self.buffer.write
+        indent = self.indent
+        ck1 = c['key']
+        cc1 = c['code']
+        wrapname = textwrap.fill(c['name'], 20, max_lines=3, placeholder="...").replace('\n',r'<BR/>')
+        icon = ' '+self.course_icons[ck1] if ck1 in self.course_icons else ''
+        w(indent*"  "+f"{ck1} [shape=plaintext, label=<\n"+
+          (indent+1)*"  "+""" <TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0">\n"""+
+          (indent+2)*"  "+f"<TR><TD>{cc1+icon}</TD></TR>\n"+
+          (indent+2)*"  "+f"<TR><TD>{wrapname}</TD></TR>\n"+
+          (indent+1)*"  "+"</TABLE> > ];\n")
+
+        cid2c = self.cid2c
+        for pr in c['com_prqs']:
+            if pr in cid2c:
+                self.all_com_prqs.append((cid2c[pr]['key'], ck1))
+        for pr in c['rec_prqs']:
+            if pr in cid2c:
+                self.all_rec_prqs.append((cid2c[pr]['key'], ck1))
+
+    def cluster_id(self, sg, parent_id):
+        """ A stable id of the cluster for the canonical mode. """
+        cluster_id = sg.get('id') or f"{parent_id}/{sg['name']}"
+        unique_id = cluster_id
+        n = 1
+        while unique_id in self.cluster_ids:
+            n+=1
+            unique_id = f"{cluster_id}#{n}"
+        self.cluster_ids.add(unique_id)
+        return unique_id
+
+    def write_cluster(self, sg, parent_id=""):
+        w = self.buffer.write
+        if self.canonical:
+            parent_id = self.cluster_id(sg, parent_id)
+            w(self.indent*"  "+"subgraph \"cluster_%s\" {\n"%parent_id.replace('"', r'\"'))
+        else:
+            w(self.indent*"  "+"subgraph cluster_%d {\n"%self.sgidx)
+            self.sgidx+=1
+        self.indent+=1
+        w(self.indent*"  "+"label = \"%s\";\n"%sg['name'])
+
+        for c in sg['children']:
+            if 'children' in c:
+                self.write_cluster(c, parent_id)
+            else:
+                if c['key'] in self.course_blacklist:
+                    continue
+                self.write_course(c)
+                self.in_clusters.add(c['key'])
+
+        self.indent-=1
+        w(self.indent*"  "+"}\n")
+
+    def write_prerequisites(self, prqs, style=""):
+        w = self.buffer.write
+        blacklist = self.course_blacklist
+        prefix = self.indent*"  "
+        suffix = f" [style=\"{style}\"];\n" if style else ";\n"
+        for from_c, to_c in prqs:
+            if from_c in blacklist or to_c in blacklist:
+                continue
+            w(f"{prefix}{from_c}->{to_c}{suffix}")
+
+    def reduce(self, styled_prqs):
+        """ Drops the prerequisite edges implied by the other edges of the same
+        style ('style') or of any style ('all'), see redundant_edges. The
+        blacklisted courses are left out first, as paths through them are
+        not drawn. """
+        blacklist = self.course_blacklist
+        styled_prqs = [([(from_c, to_c) for from_c, to_c in prqs if from_c not in blacklist and to_c not in blacklist],
+                        style) for prqs, style in styled_prqs]
+        if self.reduce_edges=='all':
+            redundant = redundant_edges([prq for prqs, _ in styled_prqs for prq in prqs])
+            reduced = [([prq for prq in prqs if prq not in redundant], style) for prqs, style in styled_prqs]
+        else:
+            reduced = []
+            for prqs, style in styled_prqs:
+                redundant = redundant_edges(prqs)
+                reduced.append( ([prq for prq in prqs if prq not in redundant], style) )
+        self.edges_before = sum(len(prqs) for prqs, _ in styled_prqs)
+        self.edges_removed = self.edges_before-sum(len(prqs) for prqs, _ in reduced)
+        return reduced
+
+    def render(self, module_hierarchy):
+        """ Returns the graphviz graph as a string. """
+        w = self.buffer.write
+        w("digraph G {\n")
+        w("rankdir=\"LR\";\n")
+
+        for sg in module_hierarchy:
+            self.write_cluster(sg)
+
+        # the edges of the loose courses written below are not drawn
+        all_com_prqs = list(self.all_com_prqs)
+        all_rec_prqs = list(self.all_rec_prqs)
+        if self.canonical:
+            all_com_prqs = sorted(set(all_com_prqs))
+            all_rec_prqs = sorted(set(all_rec_prqs))
+        styled_prqs = [(all_com_prqs, "")]
+        if self.also_recommended:
+            styled_prqs.append( (all_rec_prqs, "dashed") )
+        if self.extra_data and self.extra_data['manual_prerequisites']:
+            # it is a list of dicts
+            man_prqs = []
+            for d in self.extra_data['manual_prerequisites']:
+                man_prqs+=list(d.items())
+            if self.canonical:
+                man_prqs = sorted(set(man_prqs))
+            styled_prqs.append( (man_prqs, "dotted") )
+
+        active_prqs = set()
+        for prqs, style in styled_prqs:
+            active_prqs.update(prq for prq, c in prqs)
+        if self.reduce_edges:
+            styled_prqs = self.reduce(styled_prqs)
+        for prqs, style in styled_prqs:
+            self.write_prerequisites(prqs, style=style)
+
+        courses = self.cid2c.values()
+        if self.canonical:
+            courses = sorted(courses, key=lambda c: c['key'])
+        loose_courses = []
+        w("{ rank=source; ")
+        for c in courses:
+            cc = c['code']
+            ck = c['key']
+
+            # Might already have a node,
+            # might be blacklisted
+            # might not be added
+            if cc in self.in_clusters or \
+               ck in self.course_blacklist or \
+               ck not in active_prqs:
+                continue
+            if self.canonical and loose_courses and loose_courses[-1]['key']==ck:
+                continue
+
+            w(f"{ck}; ")
+            loose_courses.append(c)
+        w("}\n")
+
+        for c in loose_courses:
+            self.write_course(c)
+
+        w("}\n")
+        return self.buffer.getvalue()
+
+def write_gv(
+  module_hierarchy, cid2c,
+  output_gv_file_path,
+  also_recommended=True,
+  course_blacklist=[],
+  extra_data={},
+  canonical=False,
+  reduce_edges=None):
+    """ Writes a resolved module hierarchy and its courses to a graphviz file
+    with a GvWriter. Returns the graph as a string. """
+    with profiler.phase("write"):
+        writer = GvWriter(cid2c, also_recommended, course_blacklist, extra_data, canonical, reduce_edges)
+        gv = writer.render(module_hierarchy)
+        with open(output_gv_file_path, 'w', encoding="utf-8") as wf:
+            wf.write(gv)
+    if reduce_edges:
+        profiler.count("edges_removed", writer.edges_removed)
+        print(f"The transitive reduction removed {writer.edges_removed} of {writer.edges_before} "+
+              f"prerequisite edges from {output_gv_file_path}")
+    return gv
+
+# The Graphviz command used to render the graphs
+dot_command = "dot"
+# Keep the rendered files in this directory (if set) and reuse them as long
+#  as the graph does not change
+render_cache_dir = None
+
+def render_cache_path(gv_bytes, fmt):
+    """ The render cache file of the graph in the format. The key covers
+    everything that affects the output of dot. """
+    key = hashlib.sha256()
+    for part in (dot_command.encode('utf-8'), b"-T"+fmt.encode('utf-8'), gv_bytes):
+        key.update(part+b"\0")
+    return path.join(render_cache_dir, f"{key.hexdigest()}.{fmt}")
+
+def render_gv(gv, output_gv_file_path, formats):
+    """ Renders the graph (a string) with Graphviz dot to each of the formats
+    (e.g. ["svg", "png"]), each in its own dot process, so the formats are
+    laid out in parallel. The graph is piped to dot and the files are named
+    after the graphviz file. With render_cache_dir set, a graph rendered
+    before is copied from there instead. Prints the layout time of each
+    format and returns the list of the rendered files. """
+    root = path.splitext(output_gv_file_path)[0]
+    gv_bytes = gv.encode('utf-8')
+
+    def render(fmt):
+        output_file_path = f"{root}.{fmt}"
+        cached_file_path = render_cache_path(gv_bytes, fmt) if render_cache_dir else None
+        if cached_file_path and path.exists(cached_file_path):
+            shutil.copyfile(cached_file_path, output_file_path)
+            profiler.count("render_cache_hits")
+            return output_file_path, "from the render cache (the graph has not changed)"
+
+        start = time.perf_counter()
+        with profiler.phase("render"):
+            result = subprocess.run([dot_command, "-T"+fmt, "-o", output_file_path],
+                input=gv_bytes, stderr=subprocess.PIPE)
+        if result.returncode!=0:
+            logging.error(f"Rendering {output_file_path} failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+            return None, None
+        layout_time = time.perf_counter()-start
+        if cached_file_path:
+            os.makedirs(render_cache_dir, exist_ok=True)
+            # concurrent runs may render the same graph, never leave a partial file
+            tmp_file_path = f"{cached_file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            shutil.copyfile(output_file_path, tmp_file_path)
+            os.replace(tmp_file_path, cached_file_path)
+        return output_file_path, f"in {layout_time:.2f} s"
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(formats)) as pool:
+            rendered = list(pool.map(render, formats))
+    except FileNotFoundError:
+        logging.error(f"Graphviz {dot_command} command was not found, install Graphviz to render the graphs")
+        return []
+    for output_file_path, how in rendered:
+        if output_file_path:
+            print(f"Rendered {output_file_path} {how}")
+    return [output_file_path for output_file_path, _ in rendered if output_file_path]
+
 def draw_graph_for_degree_programme(
   pgid, curriculum, 
   output_gv_file_path=None,
   also_recommended=True,
   course_blacklist=[],
-  extra_data={}):
+  extra_data={},
+  workers=8,
+  resolver=None,
+  render_formats=None,
+  canonical=False,
+  reduce_edges=None):
 
     """Fetch data from Sisu (or from cache) produce a graphviz file to
     illustrate the structure, courses and course prerequisites. 
@@ -234,199 +1741,439 @@ def draw_graph_for_degree_programme(
     :param bool also_recommended: Also draw recommended courses.
     :param list course_blacklist: list of course codes/labels not to add to the graph.
     :param dict extra_data: Extra data such as course icons and manual prerequisites. Read the code.
+    :param int workers: Number of concurrent requests when prefetching the data (0 fetches lazily one by one).
+    :param CurriculumResolver resolver: Resolve the programme with this (by default a new one for the curriculum).
+    :param list render_formats: Also render the graph with dot to these formats (e.g. ["svg", "pdf"]).
+    :param bool canonical: Write the graph in the canonical order (see GvWriter).
+    :param str reduce_edges: Leave out the prerequisite edges implied by the
+      others of the same style ('style') or of all styles ('all').
      """
 
-    global cid2c
-
-    if course_blacklist:
-        course_blacklist = [cc.replace(".","_") for cc in course_blacklist]
-
-    p_data = get_cached(pgid)
-    if not p_data:
-        resp = requests.get(url=SISU_PROG_URL+pgid)
-        logging.info("Hit SISU endpoint :"+resp.url)
-        if (resp.status_code!=200):
-            logging.warning(f"Got HTTP status code {resp.status_code} when getting degree programme ID {pgid}, skipping it.")
-            return None
-
-        p_data = resp.json()
-        store_to_cache(p_data, pgid)
-
-    module_hierarchy = []
-    # TODO: make this more robust and smart as this probably assumes too much
-    #  of the degree program structure of the rules.
-    for submodule in p_data['rule']['rules'][0]['rules']:
-        gid = submodule['moduleGroupId']
-        smg =  parse_module_group(gid, curriculum)
-        if smg:
-            module_hierarchy.append(smg)
-    # Process the prerequisites now that we know all the ids
-    validate_and_clean_queued_preprequisites(curriculum)
-
-    # This removes/shrinks/combines unnecessary rules for visualization such as
-    #  credit rules, groupings etc.
-    compress(module_hierarchy)
+    if resolver is None:
+        resolver = CurriculumResolver(curriculum)
+    module_hierarchy = resolver.resolve(pgid, workers)
+    if module_hierarchy is None:
+        return None
     
     if __debug__:
         pprint(module_hierarchy)
 
     if output_gv_file_path is None:
         output_gv_file_path = pgid+".gv"
-        
-    with open(output_gv_file_path, 'w', encoding="utf-8") as wf:
-        wf.write("digraph G {\n")
-        wf.write("rankdir=\"LR\";\n")
-        
-        sgidx = 1
-        indent = 0
-
-        in_clusters = []
-        all_com_prqs = []
-        all_rec_prqs = []
-
-        def write_course(c):
-            # Closure for these
-            nonlocal indent, all_com_prqs, all_rec_prqs
-
-            ck1 = c['key']
-            cc1 = c['code']
-            wrapname = textwrap.fill(c['name'], 20, max_lines=3, placeholder="...").replace('\n',r'<BR/>')
-            icon =  ' '+extra_data['course_icons'][ck1] if extra_data and ck1 in extra_data['course_icons'] else ''
-            #wf.write(indent*"  "+f"{ck1} [shape=record, label=\"{c['code']} {icon}|{wrapname}\"];\n")
-            wf.write(indent*"  "+f"{ck1} [shape=plaintext, label=<\n"+
-            
-            (indent+1)*"  "+""" <TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0">\n"""+ 
-            (indent+2)*"  "+f"<TR><TD>{cc1+icon}</TD></TR>\n"+
-            (indent+2)*"  "+f"<TR><TD>{wrapname}</TD></TR>\n"+
-            (indent+1)*"  "+"</TABLE> > ];\n")
-
-            for pr in c['com_prqs']:
-                if pr in cid2c:
-                    c2 = cid2c[pr]
-                    ck2 = c2['key']
-                    all_com_prqs.append((ck2, ck1))
-            for pr in c['rec_prqs']:
-                if pr in cid2c:
-                    c2 = cid2c[pr]
-                    ck2 = c2['key']
-                    all_rec_prqs.append((ck2, ck1))
-        
-        def write_cluster(sg, blacklist):
-            # Closure for these
-            nonlocal sgidx, indent, in_clusters
-            
-            wf.write(indent*"  "+"subgraph cluster_%d {\n"%sgidx)
-            sgidx+=1
-            indent+=1
-            wf.write(indent*"  "+"label = \"%s\";\n"%sg['name'])
-            
-            for c in sg['children']:
-                if 'children' in c:
-                    write_cluster(c, blacklist)
-                else:
-                    if c['key'] in blacklist:
-                        continue
-                    write_course(c)
-                    in_clusters.append(c['key'])
 
-            indent-=1
-            wf.write(indent*"  "+"}\n")
-        
-        def write_prerequisites(prqs, blacklist, style=""):
-            for from_c, to_c in prqs:
-                if from_c in blacklist or to_c in blacklist: continue
+    gv = write_gv(module_hierarchy, resolver.cid2c, output_gv_file_path,
+        also_recommended, course_blacklist, extra_data, canonical, reduce_edges)
+    if render_formats:
+        render_gv(gv, output_gv_file_path, render_formats)
+    return output_gv_file_path
 
-                if style:
-                    wf.write(indent*"  "+f"{from_c}->{to_c} [style=\"{style}\"];\n")
-                else:
-                    wf.write(indent*"  "+f"{from_c}->{to_c};\n")
+def read_extra_data(file_path):
+    with open(file_path, 'r', encoding='utf-8') as rf:
+        return json.load(rf)
 
+def crawl_for_curriculums(pgid, curriculums, workers=8):
+    """ Prefetches the modules and courses of a degree programme for all the
+    curriculums in one shared crawl. Returns the number of groups crawled,
+    or None if the degree programme could not be got. """
+    crawler = CurriculumResolver(curriculums[0])
+    if crawler.use_snapshots and all(CurriculumResolver(curriculum).load_snapshot(pgid) is not None
+                                     for curriculum in curriculums):
+        return 0
+    p_data = crawler.get_programme(pgid)
+    if not p_data:
+        return None
+    if not workers:
+        return 0
+    return crawler.crawl(p_data, workers, curriculums)
 
-        for sg in module_hierarchy:
-            write_cluster(sg, course_blacklist)
-
-        active_prqs = []
-        write_prerequisites(all_com_prqs, course_blacklist, style="")
-        active_prqs+=[prq for prq, c in all_com_prqs]
-        if also_recommended:
-            write_prerequisites(all_rec_prqs, course_blacklist, style="dashed")
-            active_prqs+=[prq for prq, c in all_rec_prqs]
-        if extra_data and extra_data['manual_prerequisites']:
-            # it is a list of dicts
-            man_prqs = []
-            for d in extra_data['manual_prerequisites']:
-                man_prqs+=list(d.items())
-            write_prerequisites(man_prqs, course_blacklist, style="dotted")
-            active_prqs+=[prq for prq, c in man_prqs]
+def draw_graphs_for_years(
+  pgid, years,
+  output_gv_file_path=None,
+  also_recommended=True,
+  course_blacklist=[],
+  extra_data={},
+  workers=8,
+  render_formats=None,
+  canonical=False,
+  reduce_edges=None):
+    """ Draws a graph of the degree programme for each curriculum year. The
+    data of all the years is fetched in one crawl and each response is read
+    only once, only the versions are chosen per year. Prints the time taken
+    by the crawl and by each year.
 
-        loose_courses = []
-        wf.write("{ rank=source; ")
-        for c in cid2c.values():
-            cc = c['code']
-            ck = c['key']
+    :param list years: The curriculum years (e.g. [2022, 2023]).
+    :param str output_gv_file_path: The file name, may refer to {year} (default is "<pgid>_{year}.gv").
+    :returns: The list of the written files.
+    See draw_graph_for_degree_programme for the other parameters.
+    """
+    if output_gv_file_path is None:
+        output_gv_file_path = pgid+"_{year}.gv"
+    elif "{year}" not in output_gv_file_path:
+        root, ext = path.splitext(output_gv_file_path)
+        output_gv_file_path = root+"_{year}"+ext
 
-            # Might already have a node,
-            # might be blacklisted
-            # might not be added
-            if cc in in_clusters or \
-               ck in course_blacklist or \
-               ck not in active_prqs:
+    start = time.perf_counter()
+    crawled = crawl_for_curriculums(pgid, [CURRICULUM_CODE%year for year in years], workers)
+    if crawled is None:
+        return []
+    print(f"Crawled {crawled} modules and courses for {len(years)} curriculum years in {time.perf_counter()-start:.2f} s")
+
+    written = []
+    lookups = 0
+    for year in years:
+        year_start = time.perf_counter()
+        resolver = CurriculumResolver(CURRICULUM_CODE%year)
+        year_file_path = output_gv_file_path.format(year=year)
+        if draw_graph_for_degree_programme(pgid, resolver.curriculum, year_file_path,
+                also_recommended, course_blacklist, extra_data, workers=0, resolver=resolver,
+                render_formats=render_formats, canonical=canonical, reduce_edges=reduce_edges) is None:
+            continue
+        lookups+=len(resolver.used_ids)
+        written.append(year_file_path)
+        print(f"  {year}: {len(resolver.used_ids)} modules and courses, drawn in {time.perf_counter()-year_start:.2f} s to {year_file_path}")
+    print(f"Total {time.perf_counter()-start:.2f} s, the shared crawl covered {crawled} groups "+
+          f"where a separate run per year would get {lookups}")
+    return written
+
+def parse_years(years):
+    """ Parses a year range "2022-2024" or a list "2022,2024" of years.
+    Raises ValueError if no years are given (e.g. a reversed range). """
+    if '-' in years:
+        first, last = years.split('-')
+        parsed = list(range(int(first), int(last)+1))
+    else:
+        parsed = [int(year) for year in years.split(',')]
+    if not parsed:
+        raise ValueError(f"no years in {years}")
+    return parsed
+
+def draw_graphs_for_manifest(manifest, processes=0, workers=8, render_formats=None, canonical=False,
+                             reduce_edges=None):
+    """ Draws graphs for many degree programmes and curriculum years in one
+    go. The Sisu data is fetched and parsed in this process, so that the
+    programmes share the cache, and the graphviz files are written by a pool
+    of processes if processes is set.
+
+    :param list manifest: List of dicts with the keys "programme" (the otm id),
+      "years" (list of curriculum years, default is the current year),
+      "output" (file name, may refer to {programme} and {year}),
+      "blacklist", "extradata" (.json file) and "also_recommended".
+    :param int processes: Number of processes used to write the files (0 writes them here).
+    :param int workers: Number of concurrent requests when prefetching the data.
+    :param list render_formats: Also render the graphs with dot to these formats.
+    :param bool canonical: Write the graphs in the canonical order (see GvWriter).
+    :param str reduce_edges: Transitively reduce the prerequisite edges ('style' or 'all').
+    :returns: The list of the written graphviz files.
+    """
+    extra_datas = {}
+    written = []
+    pool = ProcessPoolExecutor(processes) if processes else None
+    try:
+        pending = []
+        for entry in manifest:
+            pgid = entry['programme']
+            extra_data = {}
+            if entry.get('extradata'):
+                if entry['extradata'] not in extra_datas:
+                    extra_datas[entry['extradata']] = read_extra_data(entry['extradata'])
+                extra_data = extra_datas[entry['extradata']]
+
+            years = entry.get('years', [date.today().year])
+            if crawl_for_curriculums(pgid, [CURRICULUM_CODE%year for year in years], workers) is None:
                 continue
+            for year in years:
+                resolver = CurriculumResolver(CURRICULUM_CODE%year)
+                module_hierarchy = resolver.resolve(pgid, workers=0)
+                if module_hierarchy is None:
+                    continue
+                output_gv_file_path = entry.get('output', "{programme}_{year}.gv").format(programme=pgid, year=year)
+                write_args = (module_hierarchy, resolver.cid2c, output_gv_file_path,
+                    entry.get('also_recommended', False), entry.get('blacklist', []), extra_data,
+                    canonical, reduce_edges)
+                if pool:
+                    pending.append( (output_gv_file_path, pool.submit(write_gv, *write_args)) )
+                else:
+                    gv = write_gv(*write_args)
+                    if render_formats:
+                        render_gv(gv, output_gv_file_path, render_formats)
+                    written.append(output_gv_file_path)
+                logging.info(f"Resolved {pgid} for the year {year}")
+        for output_gv_file_path, future in pending:
+            gv = future.result()
+            if render_formats:
+                render_gv(gv, output_gv_file_path, render_formats)
+            written.append(output_gv_file_path)
+    finally:
+        if pool:
+            pool.shutdown()
+    return written
 
-            wf.write(f"{ck}; ")
-            loose_courses.append(c)
-        wf.write("}\n")
+def parse_max_age(kind_days):
+    """ Parses a "KIND=DAYS" max age to a (kind, seconds) pair. """
+    kind, days = kind_days.split('=')
+    if kind not in CachePolicy.KINDS:
+        raise ValueError(f"unknown cache entry kind {kind}")
+    return kind, float(days)*24*60*60
 
-        for c in loose_courses:
-            write_course(c)
+def parse_cache_size(mb):
+    """ Parses a non-negative cache size in megabytes. """
+    size = float(mb)
+    if not size>=0:
+        raise ValueError(f"negative cache size {mb}")
+    return size
 
-        wf.write("}\n")
+def add_cache_policy_arguments(parser):
+    parser.add_argument("--max-age", action="append", default=[], type=parse_max_age, metavar="KIND=DAYS",
+                        help="refetch the cached data of this kind ("+", ".join(CachePolicy.KINDS)+
+                        ") when it is older than this many days, can be given for each kind")
+    parser.add_argument("--max-cache-size", default=None, type=parse_cache_size, metavar="MB",
+                        help="evict the least recently used cached data when the cache grows larger than this")
 
+def cache_policy_from_args(args):
+    max_age = dict(args.max_age)
+    max_bytes = int(args.max_cache_size*1024*1024) if args.max_cache_size is not None else None
+    return CachePolicy(max_age, max_bytes)
+
+def add_common_arguments(parser):
+    parser.add_argument("-c", "--cachedir", default=None,
+                        help="override the default cache directory (or the database file) for the Sisu data")
+    parser.add_argument("--cache-backend", default="json", choices=CACHE_BACKENDS.keys(),
+                        help="store the Sisu data as json files (default) or into a single SQLite database")
+    parser.add_argument("--cache-codec", default=None, choices=available_codecs(),
+                        help="encode the cached Sisu data as indented json (default of the json backend), "+
+                        "compact json, zlib compressed json (default of sqlite) or msgpack (if installed)")
+    add_cache_policy_arguments(parser)
+    parser.add_argument("--memo-size", default=4096, type=int,
+                        help="how many Sisu responses to keep in memory at most")
+    parser.add_argument("-w", "--workers", default=8, type=int,
+                        help="number of concurrent requests to Sisu when prefetching the data (0 disables prefetching)")
+    parser.add_argument("--base-url", default=None,
+                        help="get the Sisu data from this server instead of "+SISU_BASE_URL)
+    parser.add_argument("--revalidate", action='store_true',
+                        help="check with conditional requests if the cached Sisu data has changed and update it")
+    parser.add_argument("--projection", action='store_true',
+                        help="cache only the fields of the Sisu data that are used to draw the graphs")
+    parser.add_argument("--snapshot", action='store_true',
+                        help="cache the parsed degree programme and reuse it while its cached Sisu data has not "+
+                        "changed, skipping the crawl and the parsing (not used with --revalidate)")
+    parser.add_argument("--keep-raw", default=None, metavar="DIR",
+                        help="also store the full Sisu responses as json files to this directory (for debugging)")
+    parser.add_argument("--rate", default=0.0, type=float,
+                        help="send at most this many requests per second to Sisu (default: unlimited)")
+    parser.add_argument("--max-concurrency", default=None, type=int,
+                        help="at most this many concurrent requests to Sisu (default: the number of workers); "+
+                        "the limit is lowered automatically when Sisu throttles")
+    parser.add_argument("--target-latency", default=2.0, type=float,
+                        help="increase the request rate and concurrency only while Sisu answers within this many seconds")
+    parser.add_argument("--timeout", default=10.0, type=float,
+                        help="timeout in seconds for a single request to Sisu")
+    parser.add_argument("--retries", default=4, type=int,
+                        help="how many times to retry a request that failed or was throttled")
+    parser.add_argument("--canonical", action='store_true',
+                        help="write the graph in a canonical order that only depends on its content "+
+                        "(stable cluster names, sorted and deduplicated edges)")
+    parser.add_argument("--reduce", default=None, action='store_const', const='style',
+                        help="leave out the prerequisite edges implied by a longer chain of prerequisites of the "+
+                        "same style, e.g. A->C when there are A->B and B->C")
+    parser.add_argument("--reduce-across-styles", action='store_true',
+                        help="like --reduce, but the chains may mix compulsory, recommended and manual prerequisites")
+    parser.add_argument("--render", default=None, type=lambda s: s.split(','), metavar="FORMATS",
+                        help="also render the graph with Graphviz dot to these comma separated formats (e.g. svg,png,pdf)")
+    parser.add_argument("--dot", default="dot", help="the Graphviz dot command to render with")
+    parser.add_argument("--render-cache", default=None, metavar="DIR",
+                        help="reuse the files rendered earlier from the same graph, kept in this directory "+
+                        "(default: renders/ in the cache directory)")
+    parser.add_argument("--no-render-cache", action='store_true', help="always run dot when rendering")
+    parser.add_argument("--profile", action='store_true',
+                        help="print how much time was spent in each phase of the run")
+    parser.add_argument("--profile-json", default=None,
+                        help="write the timings and counters of the run to this .json file")
+    parser.add_argument("-v", "--verbose", dest="verbosity", action="count", default=0,
+                    help="Set verbosity level (default shows warnings, show also info = -v, also debug = -vv")
+
+def finish(args):
+    """ Closes the cache and reports on the run as asked in the arguments. """
+    logging.debug(cache.stats())
+    cache.close()
+    if raw_cache is not None:
+        raw_cache.close()
+    if fetcher.limiter.requests:
+        print(fetcher.limiter.stats())
+    if fetcher.limiter.throttled:
+        logging.warning(f"Sisu throttled {fetcher.limiter.throttled} requests, consider lowering --rate or --max-concurrency")
+    failures = profiler.counters.get("fetch_failures", 0)
+    if failures:
+        logging.warning(f"{failures} Sisu requests failed, the graphs may be incomplete")
+
+    if args.profile:
+        print(profiler.summary(), file=sys.stderr)
+    if args.profile_json:
+        report = profiler.report()
+        report['time'] = time.time()
+        report['argv'] = sys.argv[1:]
+        with open(args.profile_json, 'w', encoding='utf-8') as wf:
+            json.dump(report, wf, indent=2)
+
+def reduce_mode(args):
+    """ The reduce_edges of the --reduce and --reduce-across-styles options. """
+    return 'all' if args.reduce_across_styles else args.reduce
+
+def configure(args):
+    """ Sets up the logging, the cache and the fetcher from the command line
+    arguments added by add_common_arguments. """
+    global cache_dir, cache, fetcher, revalidate, projection, raw_cache, snapshots, dot_command, render_cache_dir
+
+    log_levels = {
+        0: logging.WARN,
+        1: logging.INFO,
+        2: logging.DEBUG,
+    }
+    logging.basicConfig(level=log_levels[min(args.verbosity,max(log_levels.keys()))])
+    
+    if args.cachedir:
+        cache_dir = args.cachedir
+    cache = MemoCache(open_cache(args.cache_backend, args.cachedir, cache_policy_from_args(args), args.cache_codec),
+        args.memo_size)
+    max_concurrency = args.max_concurrency or max(args.workers, 1)
+    limiter = AdaptiveRateLimiter(args.rate, max_concurrency, args.target_latency)
+    fetcher = SisuFetcher(args.timeout, args.retries, pool_size=max_concurrency, limiter=limiter)
+    if args.base_url:
+        set_base_url(args.base_url)
+    revalidate = args.revalidate
+    projection = args.projection
+    snapshots = args.snapshot
+    dot_command = args.dot
+    if args.no_render_cache:
+        render_cache_dir = None
+    elif args.render_cache:
+        render_cache_dir = args.render_cache
+    else:
+        # next to the database file of the sqlite backend
+        cache_location = cache_dir if args.cache_backend=='json' or path.isdir(cache_dir) else path.dirname(cache_dir)
+        render_cache_dir = path.join(cache_location, "renders")
+    if args.keep_raw:
+        raw_cache = JsonDirCache(args.keep_raw)
+
+def batch_command(argv):
+    """ The `sisu2gv.py batch manifest.json` command. """
+    import argparse
+    parser = argparse.ArgumentParser(prog="sisu2gv.py batch",
+        description="Draw many degree programmes and curriculum years in one go.")
+    parser.add_argument("manifest",
+                        help=".json file with a list of programmes to draw (see draw_graphs_for_manifest)")
+    parser.add_argument("-p", "--processes", default=0, type=int,
+                        help="write the graphviz files using this many processes")
+    add_common_arguments(parser)
+    args = parser.parse_args(argv)
+    configure(args)
+
+    with open(args.manifest, 'r', encoding='utf-8') as rf:
+        manifest = json.load(rf)
+    written = draw_graphs_for_manifest(manifest, args.processes, args.workers, args.render, args.canonical, reduce_mode(args))
+    logging.info(f"Wrote {len(written)} graphviz files")
+    finish(args)
+
+def cache_command(argv):
+    """ The `sisu2gv.py cache ...` maintenance commands. """
+    import argparse
+    parser = argparse.ArgumentParser(prog="sisu2gv.py cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="copy all the cached Sisu data to another cache backend")
+    migrate_parser.add_argument("source", help="the cache directory or database file to read from")
+    migrate_parser.add_argument("target", help="the cache directory or database file to write to")
+    migrate_parser.add_argument("--from-backend", default="json", choices=CACHE_BACKENDS.keys())
+    migrate_parser.add_argument("--to-backend", default="sqlite", choices=CACHE_BACKENDS.keys())
+    migrate_parser.add_argument("--to-codec", default=None, choices=available_codecs(),
+                        help="encode the copied data with this codec (default: the one of the target backend)")
+    migrate_parser.add_argument("--projection", action='store_true',
+                        help="copy only the fields of the Sisu data that are used to draw the graphs")
+    gc_parser = subparsers.add_parser("gc", help="evict expired cached data and shrink the cache to the max size")
+    gc_parser.add_argument("-c", "--cachedir", default=None,
+                        help="the cache directory (or the database file) to clean up")
+    gc_parser.add_argument("--cache-backend", default="json", choices=CACHE_BACKENDS.keys())
+    add_cache_policy_arguments(gc_parser)
+    gc_parser.add_argument("-n", "--dry-run", action='store_true', help="only report what would be evicted")
+    args = parser.parse_args(argv)
+
+    if args.command=="migrate":
+        from_cache = open_cache(args.from_backend, args.source)
+        to_cache = open_cache(args.to_backend, args.target, codec=args.to_codec)
+        count = migrate_cache(from_cache, to_cache, args.projection)
+        from_cache.close()
+        to_cache.close()
+        print(f"Migrated {count} cache entries from {args.source} to {args.target}")
+    elif args.command=="gc":
+        policy = cache_policy_from_args(args)
+        gc_cache = open_cache(args.cache_backend, args.cachedir)
+        evicted = collect_garbage(gc_cache, policy, args.dry_run)
+        gc_cache.close()
+        for id, kind, size, reason in evicted:
+            print(f"{'Would evict' if args.dry_run else 'Evicted'} {id} ({kind or 'unknown kind'}, {size} bytes, {reason})")
+        print(f"{'Would evict' if args.dry_run else 'Evicted'} {len(evicted)} entries, "+
+              f"{sum(size for _, _, size, _ in evicted)} bytes in total")
 
 if __name__=="__main__":
     import argparse
+    if len(sys.argv)>1 and sys.argv[1]=="cache":
+        logging.basicConfig(level=logging.INFO)
+        cache_command(sys.argv[2:])
+        sys.exit(0)
+
+    if len(sys.argv)>1 and sys.argv[1]=="batch":
+        batch_command(sys.argv[2:])
+        sys.exit(0)
+
     parser = argparse.ArgumentParser()
     parser.add_argument("degree_programme", type=str,
-                        help="the Sisu otm id for the degree program to visualize")
+                        help="the Sisu otm id for the degree program to visualize (or 'batch' / 'cache' for those commands)")
     parser.add_argument("-o", "--outputfile", default=None,
                         help="write to this file (by default the name is determined by the otm id)")
     parser.add_argument("-y", "--year", default=date.today().year, type=int,
                         help="override the curriculum year")
-    parser.add_argument("-c", "--cachedir", default=None,
-                        help="override the default cache directory for the Sisu data")
+    parser.add_argument("--years", default=None, type=parse_years,
+                        help="draw a graph for each of these curriculum years (e.g. 2022-2024 or 2022,2024) "+
+                        "sharing one crawl, the output file name may refer to {year}")
     parser.add_argument("-b", "--blacklist", action="append", help="Blacklist "+
       "these course codes from the graph. The parameter can be give multiple "+
       "times to blacklist multiple courses")
     parser.add_argument("-a", "--also_recommended", action='store_true', help = "Also show recommended course prerequisites.")
     parser.add_argument("-e", "--extradata", default=None,
                         help=".json file with some additional data (see readme)")
-    parser.add_argument("-v", "--verbose", dest="verbosity", action="count", default=0,
-                    help="Set verbosity level (default shows warnings, show also info = -v, also debug = -vv")
+    add_common_arguments(parser)
     
     args = parser.parse_args()
-    
-    log_levels = {
-        0: logging.WARN,
-        1: logging.INFO,
-        2: logging.DEBUG,
-    }
-    logging.basicConfig(level=log_levels[min(args.verbosity,max(log_levels.keys()))])
-    
-    if args.cachedir:
-        cache_dir = args.cachedir
+    configure(args)
 
     extra_data = {}
     if args.extradata:
-        with open(args.extradata, 'r', encoding='utf-8') as rf:
-            extra_data = json.load(rf)
-    
-    curriculum = "uta-lvv-%d"%args.year
+        extra_data = read_extra_data(args.extradata)
     
-    draw_graph_for_degree_programme(
-        args.degree_programme,
-        curriculum,
-        args.outputfile,
-        args.also_recommended,
-        args.blacklist,
-        extra_data
-    )
\ No newline at end of file
+    if args.years is not None:
+        draw_graphs_for_years(
+            args.degree_programme,
+            args.years,
+            args.outputfile,
+            args.also_recommended,
+            args.blacklist,
+            extra_data,
+            args.workers,
+            render_formats=args.render,
+            canonical=args.canonical,
+            reduce_edges=reduce_mode(args)
+        )
+    else:
+        curriculum = CURRICULUM_CODE%args.year
+        
+        draw_graph_for_degree_programme(
+            args.degree_programme,
+            curriculum,
+            args.outputfile,
+            args.also_recommended,
+            args.blacklist,
+            extra_data,
+            args.workers,
+            render_formats=args.render,
+            canonical=args.canonical,
+            reduce_edges=reduce_mode(args)
+        )
+    finish(args)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Usage: sisu_stub_server.py -h
+
+A local stand-in for the Sisu Kori API endpoints used by sisu2gv.py. The
+responses are served from a fixture directory that has the same format as
+the sisu2gv.py cache, so a cache from an earlier run (or one generated
+synthetically) can be served as-is. Latency, errors and throttling can be
+injected to benchmark and load-test the crawler without touching the
+university's API. Point sisu2gv.py to the stand-in with --base-url.
+"""
+
+__author__ = "Jussi Rasku"
+__copyright__ = "Copyright 2022, Jussi Rasku"
+__license__ = "MIT"
+
+import hashlib
+import json
+import logging
+import random
+import signal
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import sisu2gv
+
+PROG_PATH = '/kori/api/modules/'
+GROUP_PATH = '/kori/api/modules/by-group-id'
+COURSE_PATH = '/kori/api/course-units/by-group-id'
+
+class StubState:
+    """ The fixtures and the fault injection settings shared by the request
+    handler threads.
+
+    :param fixtures: A sisu2gv cache to serve the responses from.
+    :param float latency: Mean added latency in seconds (uniformly 0..2x).
+    :param float error_rate: Share of the requests answered with HTTP 500/503.
+    :param float throttle: Requests per second allowed before answering 429 (0 is unlimited).
+    :param str record_from: On a fixture miss, get the response from this
+      Sisu server and store it to the fixtures.
+    """
+
+    def __init__(self, fixtures, latency=0.0, error_rate=0.0, throttle=0.0, record_from=None):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.record_from = record_from.rstrip('/') if record_from else None
+        self.lock = threading.Lock()
+        self.tokens = throttle
+        self.last_refill = time.monotonic()
+        self.counts = {}
+
+    def count(self, status):
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0)+1
+
+    def take_token(self):
+        """ Token bucket that allows `throttle` requests per second. """
+        if not self.throttle:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.throttle, self.tokens+(now-self.last_refill)*self.throttle)
+            self.last_refill = now
+            if self.tokens<1.0:
+                return False
+            self.tokens-=1.0
+            return True
+
+    def lookup(self, request_path, query):
+        """ Returns the fixture data for the request or None. """
+        if request_path in (GROUP_PATH, COURSE_PATH):
+            id = query.get('groupId', [None])[0]
+        elif request_path.startswith(PROG_PATH):
+            id = request_path[len(PROG_PATH):]
+        else:
+            return None
+        if not id:
+            return None
+
+        data = self.fixtures.get(id)
+        if data is None and self.record_from:
+            data = self.record(id, request_path, query)
+        return data
+
+    def record(self, id, request_path, query):
+        import requests
+        params = {k:v[0] for k, v in query.items()}
+        resp = requests.get(self.record_from+request_path, params=params, timeout=30)
+        logging.info(f"Recorded {resp.url} ({resp.status_code})")
+        if resp.status_code!=200:
+            return None
+        data = resp.json()
+        if request_path==GROUP_PATH:
+            kind = 'module'
+        elif request_path==COURSE_PATH:
+            kind = 'course'
+        else:
+            kind = 'programme'
+        self.fixtures.put(id, data, kind=kind)
+        return data
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real API
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, format, *args):
+        logging.debug(format%args)
+
+    def send_json(self, status, data, headers={}):
+        body = json.dumps(data).encode('utf-8')
+        if status==200:
+            # ETag validators so that conditional requests can be tested
+            etag = '"%s"'%hashlib.sha1(body).hexdigest()
+            headers = dict(headers, ETag=etag)
+            if self.headers.get('If-None-Match')==etag:
+                status = 304
+                body = b''
+        # counted before the response is sent, so that a client that got it sees the count
+        self.state.count(status)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.state
+        if state.latency:
+            time.sleep(random.uniform(0, 2*state.latency))
+        if not state.take_token():
+            self.send_json(429, {'error':'throttled'}, {'Retry-After':'1'})
+            return
+        if state.error_rate and random.random()<state.error_rate:
+            self.send_json(random.choice((500, 503)), {'error':'injected error'})
+            return
+
+        url = urlsplit(self.path)
+        data = state.lookup(url.path, parse_qs(url.query))
+        if data is None:
+            self.send_json(404, {'error':'not found'})
+        else:
+            self.send_json(200, data)
+
+def make_server(state, host='127.0.0.1', port=0):
+    """ Creates (but does not start) the stand-in server. With port 0 a free
+    port is picked, see server.server_address. """
+    handler = type('BoundStubHandler', (StubHandler,), {'state':state})
+    return ThreadingHTTPServer((host, port), handler)
+
+def start_in_thread(state, host='127.0.0.1', port=0):
+    """ Starts the stand-in in a background thread and returns the server
+    and its base url (for sisu2gv.set_base_url). """
+    server = make_server(state, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fixtures",
+                        help="the directory (or SQLite file) with the responses in the sisu2gv cache format")
+    parser.add_argument("--cache-backend", default="json", choices=sisu2gv.CACHE_BACKENDS.keys(),
+                        help="the format of the fixtures")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", default=8080, type=int)
+    parser.add_argument("--latency", default=0.0, type=float,
+                        help="mean latency in milliseconds to add to each response")
+    parser.add_argument("--error-rate", default=0.0, type=float,
+                        help="share (0..1) of the requests to fail with HTTP 500/503")
+    parser.add_argument("--throttle", default=0.0, type=float,
+                        help="answer HTTP 429 when there are more than this many requests per second")
+    parser.add_argument("--record", default=None, metavar="SISU_URL",
+                        help="get missing responses from this server (e.g. "+sisu2gv.SISU_BASE_URL+") and store them as fixtures")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    fixtures = sisu2gv.open_cache(args.cache_backend, args.fixtures)
+    state = StubState(fixtures, args.latency/1000.0, args.error_rate, args.throttle, args.record)
+    server = make_server(state, args.host, args.port)
+    host, port = server.server_address[:2]
+    logging.info(f"Serving {args.fixtures} at http://{host}:{port} (use sisu2gv.py --base-url http://{host}:{port})")
+    # stop cleanly also when terminated by a job runner
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        fixtures.close()
+        logging.info(f"Responses by status: {state.counts}")
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Usage: sisu_synth.py -h
+
+Generates a synthetic degree programme shaped like the Sisu data and writes
+it straight into the sisu2gv.py cache format, so that the parsing, the
+prerequisite validation and the graph writing can be benchmarked offline
+with 1k, 10k or 100k courses. The same data can also be served with
+sisu_stub_server.py to benchmark the crawler.
+"""
+
+__author__ = "Jussi Rasku"
+__copyright__ = "Copyright 2022, Jussi Rasku"
+__license__ = "MIT"
+
+import random
+
+import sisu2gv
+
+LOREM = ("Opintojakson suorittanut opiskelija osaa soveltaa keskeisiä "
+         "menetelmiä ja tuntee alan käsitteet. ")
+
+def name(kind, n):
+    return {'fi':f"{kind} {n}", 'en':f"{kind} {n} (en)", 'sv':f"{kind} {n} (sv)"}
+
+def description(rnd):
+    text = LOREM*rnd.randint(1, 4)
+    return {'fi':text, 'en':text, 'sv':text}
+
+def periods_for(rnd, curriculums):
+    """ Most entries are valid for all the curriculums listed, some for no
+    periods (i.e. all) and some for only a part of them. """
+    r = rnd.random()
+    if r<0.1:
+        return []
+    if r<0.25 and len(curriculums)>1:
+        return rnd.sample(curriculums, rnd.randint(1, len(curriculums)-1))
+    return list(curriculums)
+
+def prerequisite_rules(cids):
+    return [{'prerequisites':[{'type':'CourseUnit', 'courseUnitGroupId':cid}]} for cid in cids]
+
+class SynthProgramme:
+    """ Builds the Sisu-shaped responses of one synthetic programme.
+
+    :param int courses: Number of courses in the module tree.
+    :param int depth: Number of module levels below the programme.
+    :param int fanout: Number of submodules in each module.
+    :param float prereq_density: Mean number of prerequisites per course.
+    :param list years: Curriculum years the data is valid for.
+    :param float extra_share: Share of prerequisites outside the module tree.
+    :param float alt_share: Share of courses that are also in another module.
+    :param int seed: Random seed, the same parameters give the same data.
+    """
+
+    def __init__(self, courses=1000, depth=2, fanout=4, prereq_density=1.5,
+                 years=(2022,), extra_share=0.1, alt_share=0.02, seed=1):
+        self.rnd = random.Random(seed)
+        self.n_courses = courses
+        self.depth = depth
+        self.fanout = fanout
+        self.prereq_density = prereq_density
+        self.curriculums = [sisu2gv.CURRICULUM_CODE%year for year in years]
+        self.extra_share = extra_share
+        self.alt_share = alt_share
+        self.seed = seed
+        self.entries = {}
+        self.course_ids = []
+        self.extra_ids = []
+
+    def course_id(self, n):
+        return f"synth-cu-{self.seed}-{n}"
+
+    def make_course(self, cid, n, candidates):
+        rnd = self.rnd
+        n_prqs = int(self.prereq_density)+(rnd.random()<self.prereq_density%1)
+        prqs = []
+        for _ in range(n_prqs):
+            if self.extra_ids and rnd.random()<self.extra_share:
+                prqs.append(rnd.choice(self.extra_ids))
+            elif candidates:
+                # prerequisites point to earlier courses, the graph stays a DAG
+                prqs.append(candidates[rnd.randrange(max(0, len(candidates)-200), len(candidates))])
+        split = rnd.randint(0, len(prqs))
+        version = {
+            'id':f"{cid}-v1",
+            'groupId':cid,
+            'code':f"SYN.{n}",
+            'name':name("Kurssi", n),
+            'credits':{'min':5, 'max':5},
+            'curriculumPeriodIds':periods_for(rnd, self.curriculums),
+            'content':description(rnd),
+            'outcomes':description(rnd),
+            'recommendedFormalPrerequisites':prerequisite_rules(prqs[:split]),
+            'compulsoryFormalPrerequisites':prerequisite_rules(prqs[split:]),
+        }
+        versions = [version]
+        if len(self.curriculums)>1 and rnd.random()<0.2:
+            # a renewed version of the course for the later curriculums
+            renewed = dict(version, id=f"{cid}-v2", name=name("Uudistettu kurssi", n),
+                curriculumPeriodIds=self.curriculums[len(self.curriculums)//2:])
+            version['curriculumPeriodIds'] = self.curriculums[:len(self.curriculums)//2]
+            versions.append(renewed)
+        self.entries[cid] = versions
+
+    def make_courses(self):
+        n_extra = int(self.n_courses*self.extra_share)
+        for n in range(n_extra):
+            cid = self.course_id(f"x{n}")
+            self.extra_ids.append(cid)
+            self.make_course(cid, f"X{n}", [])
+        for n in range(self.n_courses):
+            cid = self.course_id(n)
+            self.make_course(cid, n, self.course_ids)
+            self.course_ids.append(cid)
+
+    def course_rules(self, cids):
+        rnd = self.rnd
+        rules = []
+        mandatory = []
+        for cid in cids:
+            rule = {'type':'CourseUnitRule', 'courseUnitGroupId':cid}
+            if rnd.random()<0.3:
+                mandatory.append(rule)
+            else:
+                rules.append(rule)
+        if mandatory:
+            rules.insert(0, {'type':'CompositeRule', 'allMandatory':True, 'rules':mandatory})
+        if len(rules)>4 and rnd.random()<0.3:
+            # a described grouping of optional courses
+            rules = rules[:2]+[{'type':'CompositeRule', 'allMandatory':False,
+                'description':{'fi':"<p>Valitse vähintään yksi</p>", 'en':"<p>Choose at least one</p>"},
+                'rules':rules[2:]}]
+        return rules
+
+    def make_module(self, path, level, cids):
+        gid = "synth-mg-%d-%s"%(self.seed, "-".join(str(i) for i in path))
+        if level==self.depth:
+            rules = self.course_rules(cids)
+        else:
+            rules = []
+            chunk = -(-len(cids)//self.fanout)
+            for i in range(self.fanout):
+                child_cids = cids[i*chunk:(i+1)*chunk]
+                if child_cids:
+                    rules.append({'type':'ModuleRule', 'moduleGroupId':self.make_module(path+[i], level+1, child_cids)})
+        self.entries[gid] = [{
+            'id':gid+"-v1",
+            'groupId':gid,
+            'code':"SYN-M-"+"-".join(str(i) for i in path),
+            'name':name("Moduuli", ".".join(str(i+1) for i in path)),
+            'type':'StudyModule',
+            'curriculumPeriodIds':[] if self.rnd.random()<0.2 else list(self.curriculums),
+            'description':description(self.rnd),
+            'rule':{'type':'CreditsRule', 'credits':{'min':len(cids)*5},
+                    'rule':{'type':'CompositeRule', 'allMandatory':False, 'rules':rules}},
+        }]
+        return gid
+
+    def generate(self):
+        """ Returns the programme id and a dict of all the responses by id. """
+        self.make_courses()
+        cids = list(self.course_ids)
+        # some courses are in two modules (the _alt case in parse_course)
+        for cid in self.rnd.sample(self.course_ids, int(len(self.course_ids)*self.alt_share)):
+            cids.insert(self.rnd.randrange(len(cids)), cid)
+
+        pgid = f"otm-synth-{self.seed}-{self.n_courses}"
+        top_rules = []
+        chunk = -(-len(cids)//self.fanout)
+        for i in range(self.fanout):
+            child_cids = cids[i*chunk:(i+1)*chunk]
+            if child_cids:
+                top_rules.append({'type':'ModuleRule', 'moduleGroupId':self.make_module([i], 1, child_cids)})
+        self.entries[pgid] = {
+            'id':pgid,
+            'code':"SYN",
+            'name':name("Synteettinen ohjelma", self.n_courses),
+            'type':'DegreeProgramme',
+            'curriculumPeriodIds':list(self.curriculums),
+            'rule':{'type':'CompositeRule', 'allMandatory':True,
+                    'rules':[{'type':'CompositeRule', 'allMandatory':True, 'rules':top_rules}]},
+        }
+        return pgid, self.entries
+
+def generate_to_cache(to_cache, **params):
+    """ Generates a synthetic programme into a sisu2gv cache, returns the
+    programme id. See SynthProgramme for the parameters. """
+    pgid, entries = SynthProgramme(**params).generate()
+    for id, data in entries.items():
+        if id==pgid:
+            kind = 'programme'
+        elif id.startswith("synth-mg-"):
+            kind = 'module'
+        else:
+            kind = 'course'
+        to_cache.put(id, data, kind=kind)
+    return pgid
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cachedir", help="the cache directory (or the SQLite file) to write to")
+    parser.add_argument("--cache-backend", default="json", choices=sisu2gv.CACHE_BACKENDS.keys())
+    parser.add_argument("-n", "--courses", default=1000, type=int, help="number of courses in the module tree")
+    parser.add_argument("-d", "--depth", default=2, type=int, help="number of module levels")
+    parser.add_argument("-f", "--fanout", default=4, type=int, help="number of submodules per module")
+    parser.add_argument("-p", "--prereq-density", default=1.5, type=float, help="mean number of prerequisites per course")
+    parser.add_argument("--years", default=[2022], type=sisu2gv.parse_years,
+                        help="curriculum years of the data (e.g. 2022-2024)")
+    parser.add_argument("--seed", default=1, type=int)
+    args = parser.parse_args()
+
+    to_cache = sisu2gv.open_cache(args.cache_backend, args.cachedir)
+    pgid = generate_to_cache(to_cache, courses=args.courses, depth=args.depth, fanout=args.fanout,
+        prereq_density=args.prereq_density, years=args.years, seed=args.seed)
+    to_cache.close()
+    print(pgid)
@@ -0,0 +1,254 @@
+"""
+Tests for the command line parsing and the graph writing of sisu2gv.py.
+"""
+
+import logging
+import os
+import random
+import sys
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+import sisu2gv
+import sisu_synth
+
+def test_parse_years():
+    assert sisu2gv.parse_years("2022-2024")==[2022, 2023, 2024]
+    assert sisu2gv.parse_years("2023-2023")==[2023]
+    assert sisu2gv.parse_years("2022,2024")==[2022, 2024]
+
+@pytest.mark.parametrize("years", ["2024-2022", "2022-", "2022,", "twenty"])
+def test_parse_years_rejects_no_years(years):
+    with pytest.raises(ValueError):
+        sisu2gv.parse_years(years)
+
+def test_parse_max_age():
+    assert sisu2gv.parse_max_age("course=2")==("course", 2*24*60*60)
+
+@pytest.mark.parametrize("kind_days", ["course", "lecture=2", "course=soon"])
+def test_parse_max_age_rejects_bad_values(kind_days):
+    with pytest.raises(ValueError):
+        sisu2gv.parse_max_age(kind_days)
+
+def test_parse_cache_size():
+    assert sisu2gv.parse_cache_size("0")==0.0
+    assert sisu2gv.parse_cache_size("2.5")==2.5
+    for mb in ("-5", "nan", "big"):
+        with pytest.raises(ValueError):
+            sisu2gv.parse_cache_size(mb)
+
+class ModulesExpired(sisu2gv.CachePolicy):
+    def is_expired(self, kind, fetched_at, now=None):
+        return kind=='module'
+
+@pytest.mark.parametrize("backend", sorted(sisu2gv.CACHE_BACKENDS))
+def test_eviction_reasons_are_logged_on_close(backend, tmp_path, caplog):
+    location = str(tmp_path/"cache")
+    cache = sisu2gv.open_cache(backend, location)
+    for i in range(4):
+        cache.put(f"otm-{i}", {'id':f"otm-{i}", 'padding':os.urandom(500).hex()}, kind='course')
+    cache.put("otm-module", {'id':"otm-module"}, kind='module')
+    course_bytes = sum(size for _, kind, _, _, size in cache.entries_info() if kind=='course')
+    cache.close()
+
+    # one course has to go in addition to the expired module
+    cache = sisu2gv.open_cache(backend, location, ModulesExpired(max_bytes=course_bytes-1))
+    with caplog.at_level(logging.INFO):
+        cache.close()
+    assert f"Evicted 2 entries from the cache (1 expired, 1 to keep it under {course_bytes-1} bytes)" in caplog.text
+
+def course(code):
+    return {'key':code, 'code':code, 'name':"Kurssi "+code, 'com_prqs':[], 'rec_prqs':[]}
+
+def module(gid, codes):
+    """ A module that only holds a grouping of courses (which compress
+    promotes in its place). """
+    return {'name':"Moduuli "+gid, 'type':'StudyModule', 'id':gid, 'children':[
+        {'name':"Pakolliset", 'type':'CompositeRule', 'children':[course(code) for code in codes]}]}
+
+def cluster_lines(module_hierarchy, cid2c):
+    sisu2gv.compress(module_hierarchy)
+    gv = sisu2gv.GvWriter(cid2c, canonical=True).render(module_hierarchy)
+    return {line.strip() for line in gv.splitlines() if line.strip().startswith("subgraph")}
+
+def test_canonical_cluster_ids_do_not_depend_on_the_other_modules():
+    cid2c = {code:course(code) for code in ("A_1", "A_2", "B_1", "C_1")}
+    before = cluster_lines([module("otm-a", ["A_1", "A_2"]), module("otm-b", ["B_1"])], cid2c)
+    after = cluster_lines([module("otm-c", ["C_1"]), module("otm-a", ["A_1", "A_2"]), module("otm-b", ["B_1"])], cid2c)
+    assert before=={'subgraph "cluster_otm-a" {', 'subgraph "cluster_otm-b" {'}
+    assert after==before|{'subgraph "cluster_otm-c" {'}
+
+class FakeResponse:
+    headers = {}
+    def __init__(self, url, data, status_code=200):
+        self.url = url
+        self.data = data
+        self.status_code = status_code
+    def json(self):
+        return self.data
+
+class SlowFetcher:
+    """ Answers every request after a delay, long enough for concurrent
+    fetches of the same id to overlap. """
+    def __init__(self):
+        self.requests = 0
+    def get(self, url, params=None, headers=None):
+        self.requests+=1
+        sisu2gv.time.sleep(0.2)
+        return FakeResponse(url, {'id':"otm-shared"})
+
+def test_concurrent_fetches_share_a_flight_only_for_the_same_cache(tmp_path):
+    fetcher = SlowFetcher()
+    cache_a, cache_b = [sisu2gv.open_cache('json', str(tmp_path/name)) for name in ("a", "b")]
+    # two resolvers share cache_a, a third one has a cache of its own
+    resolvers = [sisu2gv.CurriculumResolver("uta-lvv-2022", response_cache=cache, sisu_fetcher=fetcher)
+        for cache in (cache_a, cache_a, cache_b)]
+    with sisu2gv.ThreadPoolExecutor(3) as pool:
+        results = list(pool.map(lambda resolver: resolver.get_programme("otm-shared"), resolvers))
+    assert results==[{'id':"otm-shared"}]*3
+    assert fetcher.requests==2
+    assert cache_a.get("otm-shared")==cache_b.get("otm-shared")=={'id':"otm-shared"}
+
+@pytest.mark.parametrize("backend", sorted(sisu2gv.CACHE_BACKENDS))
+def test_entries_without_a_kind_expire(backend, tmp_path):
+    location = str(tmp_path/"cache")
+    cache = sisu2gv.open_cache(backend, location)
+    # as written before the kinds were stored
+    cache.put("otm-course", [{'code':"KURSSI_1", 'name':{'fi':"Kurssi"}}])
+    cache.put("otm-programme", {'id':"otm-programme", 'rule':{}})
+    cache.close()
+
+    policy = sisu2gv.CachePolicy({'course':0})
+    cache = sisu2gv.open_cache(backend, location, policy)
+    assert cache.get("otm-course") is None
+    assert cache.get("otm-course", include_expired=True) is not None
+    assert cache.get("otm-programme") is not None
+    assert cache.stamps(["otm-course"])=={"otm-course":None}
+    evicted = sisu2gv.collect_garbage(cache, policy, dry_run=True)
+    assert evicted==[("otm-course", 'course', evicted[0][2], "expired")]
+    cache.close()
+
+    # the guessed kinds are stored
+    cache = sisu2gv.open_cache(backend, location)
+    assert sorted((id, kind) for id, kind, _, _, _ in cache.entries_info())== \
+        [("otm-course", 'course'), ("otm-programme", 'programme')]
+    cache.close()
+
+class DictFetcher:
+    """ Answers the requests from a dict of Sisu data, with HTTP 404 for the
+    ids not in it or the given status for the ids in failing. """
+    def __init__(self, entries, failing={}):
+        self.entries = entries
+        self.failing = failing
+        self.requested = []
+    def get(self, url, params=None, headers=None):
+        id = params['groupId'] if params else url.rsplit('/', 1)[1]
+        self.requested.append(id)
+        if id in self.failing:
+            return FakeResponse(url, None, self.failing[id])
+        if id not in self.entries:
+            return FakeResponse(url, None, 404)
+        return FakeResponse(url, self.entries[id])
+
+def synth_programme_without_a_course(year=2022):
+    pgid, entries = sisu_synth.SynthProgramme(courses=30, years=[year]).generate()
+    dead_id = sorted(id for id in entries if id!=pgid and not id.startswith("synth-mg-"))[0]
+    del entries[dead_id]
+    return pgid, entries, dead_id
+
+def resolve_with_snapshots(cache, fetcher, pgid, year=2022):
+    resolver = sisu2gv.CurriculumResolver(sisu2gv.CURRICULUM_CODE%year, response_cache=cache,
+        sisu_fetcher=fetcher, use_snapshots=True)
+    return resolver, resolver.resolve(pgid, workers=0)
+
+def test_snapshot_is_kept_while_data_is_missing(tmp_path):
+    pgid, entries, dead_id = synth_programme_without_a_course()
+    cache = sisu2gv.MemoCache(sisu2gv.open_cache('json', str(tmp_path)))
+    fetcher = DictFetcher(entries)
+    resolver, module_hierarchy = resolve_with_snapshots(cache, fetcher, pgid)
+    assert dead_id in fetcher.requested
+
+    fetcher.requested = []
+    snapshot_resolver, snapshot_hierarchy = resolve_with_snapshots(cache, fetcher, pgid)
+    assert fetcher.requested==[]
+    assert snapshot_hierarchy==module_hierarchy
+    assert snapshot_resolver.cid2c==resolver.cid2c
+
+    # the data is not missing anymore
+    cache.put(dead_id, [{'code':"DEAD_1"}], kind='course')
+    assert snapshot_resolver.load_snapshot(pgid) is None
+
+def test_no_snapshot_after_a_transient_failure(tmp_path):
+    pgid, entries, dead_id = synth_programme_without_a_course()
+    cache = sisu2gv.MemoCache(sisu2gv.open_cache('json', str(tmp_path)))
+    module_id = sorted(id for id in entries if id.startswith("synth-mg-"))[0]
+    resolver, _ = resolve_with_snapshots(cache, DictFetcher(entries, {module_id:503}), pgid)
+    assert resolver.load_snapshot(pgid) is None
+    assert cache.get(resolver.snapshot_id(pgid)) is None
+
+def test_snapshot_is_rejected_when_an_input_changes(tmp_path):
+    pgid, entries = sisu_synth.SynthProgramme(courses=30, years=[2022]).generate()
+    cache = sisu2gv.MemoCache(sisu2gv.open_cache('json', str(tmp_path)))
+    resolver, module_hierarchy = resolve_with_snapshots(cache, DictFetcher(entries), pgid)
+    assert resolver.load_snapshot(pgid)==module_hierarchy
+
+    course_id = sorted(id for id in resolver.used_ids if id!=pgid and not id.startswith("synth-mg-"))[0]
+    changed = [dict(version, name={'fi':"Muuttunut nimi"}) for version in cache.get(course_id)]
+    cache.put(course_id, changed, kind='course')
+    assert resolver.load_snapshot(pgid) is None
+
+def reachable(successors, start):
+    """ The nodes reachable from start with at least one edge (depth-first). """
+    seen = set()
+    todo = list(successors.get(start, ()))
+    while todo:
+        node = todo.pop()
+        if node not in seen:
+            seen.add(node)
+            todo.extend(successors.get(node, ()))
+    return seen
+
+def brute_force_redundant_edges(edges):
+    successors = {}
+    for from_c, to_c in edges:
+        successors.setdefault(from_c, set()).add(to_c)
+    cyclic = {node for node in successors if node in reachable(successors, node)}
+    dag = {from_c:{to_c for to_c in to_cs if to_c not in cyclic}
+           for from_c, to_cs in successors.items() if from_c not in cyclic}
+    return {(from_c, to_c) for from_c, to_c in edges if from_c in dag and to_c in dag[from_c] and
+        any(to_c in reachable(dag, via) for via in dag[from_c] if via!=to_c)}, cyclic
+
+def random_edges(rnd):
+    nodes = rnd.randint(1, 12)
+    return [(f"C{rnd.randrange(nodes)}", f"C{rnd.randrange(nodes)}") for _ in range(rnd.randint(0, 30))]
+
+def test_redundant_edges_match_brute_force():
+    rnd = random.Random(1)
+    for _ in range(2000):
+        edges = random_edges(rnd)
+        expected, cyclic = brute_force_redundant_edges(edges)
+        successors = {}
+        for from_c, to_c in edges:
+            successors.setdefault(from_c, set()).add(to_c)
+        assert sisu2gv.cyclic_nodes(successors)==cyclic, edges
+        redundant = sisu2gv.redundant_edges(edges)
+        assert redundant==expected, edges
+        # the reduction keeps every course reachable from the same courses
+        reduced = {}
+        for from_c, to_c in edges:
+            if (from_c, to_c) not in redundant:
+                reduced.setdefault(from_c, set()).add(to_c)
+        for node in successors:
+            assert reachable(reduced, node)==reachable(successors, node), edges
+
+def test_redundant_edges_with_cycles_and_self_loops():
+    # A->C is implied by A->B->C, the cycle D<->E and the self-loop F->F keep their edges
+    edges = [("A", "B"), ("B", "C"), ("A", "C"), ("D", "E"), ("E", "D"), ("D", "C"), ("A", "D"),
+             ("F", "F"), ("F", "A"), ("F", "B")]
+    successors = {}
+    for from_c, to_c in edges:
+        successors.setdefault(from_c, set()).add(to_c)
+    assert sisu2gv.cyclic_nodes(successors)=={"D", "E", "F"}
+    assert sisu2gv.redundant_edges(edges)=={("A", "C")}
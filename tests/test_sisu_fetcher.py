@@ -0,0 +1,140 @@
+"""
+Tests for the retries of SisuFetcher.get against the local Sisu stand-in
+(sisu_stub_server.py) with injected errors, throttling and latency.
+"""
+
+import sys
+import time
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+import sisu2gv
+import sisu_stub_server
+
+PGID = "otm-test-programme"
+
+class WorstCaseRandom:
+    """ Makes the fault injection of the stand-in deterministic: the
+    injected latency is always the maximum and the errors always hit. """
+    @staticmethod
+    def uniform(a, b):
+        return b
+    @staticmethod
+    def random():
+        return 0.0
+    @staticmethod
+    def choice(seq):
+        return seq[0]
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    monkeypatch.setattr(sisu_stub_server, "random", WorstCaseRandom)
+    fixtures = sisu2gv.JsonDirCache(str(tmp_path))
+    fixtures.put(PGID, {'id':PGID, 'name':{'fi':"Testiohjelma"}}, kind='programme')
+    state = sisu_stub_server.StubState(fixtures)
+    server, base_url = sisu_stub_server.start_in_thread(state)
+    yield state, base_url+sisu_stub_server.PROG_PATH+PGID
+    server.shutdown()
+    server.server_close()
+
+class RecordedSleeps:
+    """ Stands in for the time module in sisu2gv, records the delays
+    SisuFetcher.get waits between the attempts instead of sleeping. The
+    stand-in server still sleeps for real. """
+    def __init__(self, on_sleep=None):
+        self.delays = []
+        self.on_sleep = on_sleep
+    def __getattr__(self, name):
+        return getattr(time, name)
+    def sleep(self, delay):
+        self.delays.append(delay)
+        if self.on_sleep:
+            self.on_sleep(self.delays)
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    recorded = RecordedSleeps()
+    monkeypatch.setattr(sisu2gv, "time", recorded)
+    return recorded.delays
+
+def test_success_is_not_retried(stub, sleeps):
+    state, url = stub
+    resp = sisu2gv.SisuFetcher(retries=3).get(url)
+    assert resp.status_code==200
+    assert resp.json()['id']==PGID
+    assert sleeps==[]
+    assert state.counts=={200:1}
+
+def test_server_errors_are_retried_until_the_last_attempt(stub, sleeps):
+    state, url = stub
+    state.error_rate = 1.0
+    resp = sisu2gv.SisuFetcher(retries=3, backoff=0.5).get(url)
+    # the response of the last attempt is returned as-is
+    assert resp.status_code==500
+    assert state.counts=={500:4}
+    assert len(sleeps)==3
+    for attempt, delay in enumerate(sleeps):
+        assert 0.5*0.5*2**attempt<=delay<=0.5*2**attempt
+
+def test_backoff_is_capped(stub, sleeps):
+    state, url = stub
+    state.error_rate = 1.0
+    sisu2gv.SisuFetcher(retries=4, backoff=1.0, max_backoff=2.0).get(url)
+    assert len(sleeps)==4
+    assert all(delay<=2.0 for delay in sleeps)
+
+def test_recovers_after_server_errors(stub, monkeypatch):
+    state, url = stub
+    state.error_rate = 1.0
+    def stop_errors(delays):
+        if len(delays)==2:
+            state.error_rate = 0.0
+    recorded = RecordedSleeps(stop_errors)
+    monkeypatch.setattr(sisu2gv, "time", recorded)
+    resp = sisu2gv.SisuFetcher(retries=4).get(url)
+    assert resp.status_code==200
+    assert len(recorded.delays)==2
+    assert state.counts=={500:2, 200:1}
+
+def test_throttling_waits_for_retry_after(stub, sleeps):
+    state, url = stub
+    # less than one token per request, every request is answered with 429
+    state.throttle = state.tokens = 0.001
+    resp = sisu2gv.SisuFetcher(retries=2, backoff=30.0).get(url)
+    assert resp.status_code==429
+    assert state.counts=={429:3}
+    # the stand-in asks to retry after 1 s, instead of the 30 s backoff
+    assert sleeps==[1.0, 1.0]
+
+def test_retry_after_is_capped(stub, sleeps):
+    state, url = stub
+    state.throttle = state.tokens = 0.001
+    sisu2gv.SisuFetcher(retries=1, max_backoff=0.25).get(url)
+    assert sleeps==[0.25]
+
+def test_timeouts_give_none(stub, sleeps):
+    state, url = stub
+    state.latency = 0.5
+    resp = sisu2gv.SisuFetcher(timeout=0.1, retries=2, backoff=0.5).get(url)
+    assert resp is None
+    assert len(sleeps)==2
+    for attempt, delay in enumerate(sleeps):
+        assert 0.5*0.5*2**attempt<=delay<=0.5*2**attempt
+
+def test_limiter_halves_once_per_congestion_event():
+    limiter = sisu2gv.AdaptiveRateLimiter(max_concurrency=16)
+    for _ in range(16):
+        limiter.acquire()
+    time.sleep(0.01)
+    # a burst of throttled responses to requests sent at the same time
+    for _ in range(16):
+        limiter.release(429, 0.01)
+    assert limiter.limit==8.0
+    assert limiter.throttled==16
+    # a request sent after the decrease is a new event
+    limiter.acquire()
+    time.sleep(0.01)
+    limiter.release(429, 0.005)
+    assert limiter.limit==4.0